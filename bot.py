@@ -2,31 +2,115 @@ import os
 import sys
 import json
 import time
+import math
 import logging
 import asyncio
-import requests
+import sqlite3
+import httpx
+import numpy as np
+import heapq
+import queue
+import hashlib
+import base64
+import gzip
+import threading
+import multiprocessing
+import argparse
+import bisect
+import functools
 import subprocess
-from datetime import datetime
-from dotenv import load_dotenv, set_key
-from py_clob_client.client import ClobClient
-from py_clob_client.clob_types import OrderArgs
-from py_clob_client.order_builder.constants import BUY, SELL
+import atexit
+import signal
+import importlib.util
+from array import array
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from itertools import accumulate, product
+from operator import itemgetter
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+from dotenv import load_dotenv, set_key, dotenv_values
+# py_clob_client 导入很慢（web3 / eth 依赖），只在真正下单时才导入，见 create_clob_client
 
 # ==================== 配置 ====================
 ENV_FILE = ".env"
 CLOB_HOST = "https://clob.polymarket.com"
 CHAIN_ID = 137
+STREAM_URL = "wss://ws-live-data.polymarket.com"
 
 # ==================== 日志配置 ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s | %(levelname)-5s | %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("bot.log", mode='a')
-    ]
-)
+TEXT_LOG_FORMAT = '%(asctime)s | %(levelname)-5s | %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行 JSON：时间、级别、消息，以及 extra= 传入的字段"""
+    _STANDARD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+    
+    def format(self, record):
+        entry = {"ts": record.created, "level": record.levelname, "msg": record.getMessage()}
+        for key, value in record.__dict__.items():
+            if key not in self._STANDARD:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    """只把 LogRecord 放进队列，消息格式化推迟到后台写线程
+    
+    标准 QueueHandler.prepare 会在调用线程里先格式化一遍；这里同进程内传递，
+    日志参数都是不可变的数字和字符串，直接入队即可。
+    """
+    
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """日志经队列交给后台线程写 stdout 和 bot.log（按大小轮转），事件循环里只做一次入队
+    
+    LOG_FORMAT=json 时按 JSON lines 输出；LOG_FILE / LOG_MAX_BYTES / LOG_BACKUPS / LOG_LEVEL 可配置。
+    此时 .env 还没加载，从环境变量和 .env 文件两处读取。
+    """
+    settings = dotenv_values(ENV_FILE) if os.path.exists(ENV_FILE) else {}
+    get = lambda key, default: os.getenv(key) or settings.get(key) or default
+    formatter = JsonFormatter() if get("LOG_FORMAT", "text").lower() == "json" else logging.Formatter(TEXT_LOG_FORMAT)
+    log_file = get("LOG_FILE", "bot.log")
+    if multiprocessing.current_process().name == "MainProcess":
+        file_handler = RotatingFileHandler(log_file, maxBytes=int(get("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+                                           backupCount=int(get("LOG_BACKUPS", "5")), encoding="utf-8")
+    else:
+        # 分片子进程只追加，轮转交给主进程，避免多个进程同时改名
+        file_handler = logging.FileHandler(log_file, mode='a', encoding="utf-8")
+    handlers = [logging.StreamHandler(sys.stdout), file_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(get("LOG_LEVEL", "INFO").upper())
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # 退出时写完队列里剩余的日志
+    return log_file
+
+def tail_lines(path: str, n: int = 5, block: int = 4096) -> list:
+    """从文件末尾按块向前读取最后 n 行，不加载整个文件"""
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        data = b""
+        while end > 0 and data.count(b"\n") <= n:
+            step = min(block, end)
+            end -= step
+            f.seek(end)
+            data = f.read(step) + data
+    return [line.decode("utf-8", "replace") for line in data.splitlines()[-n:]]
+
+LOG_FILE = setup_logging()
 logger = logging.getLogger(__name__)
+# 第三方库的逐请求日志太吵
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("websockets").setLevel(logging.WARNING)
 
 # ==================== 自动检查并安装依赖 ====================
 def check_and_install_dependencies():
@@ -35,18 +119,21 @@ def check_and_install_dependencies():
     print("自动检查依赖...")
     print("="*60)
     
+    # 模块名 -> pip 包；只查找不导入，py_clob_client 导入一次要 1 秒左右
     requirements = {
-        "requests": "requests>=2.28.0",
-        "python-dotenv": "python-dotenv>=1.0.0",
-        "py_clob_client": "py-clob-client>=0.34.0"
+        "httpx": "httpx>=0.27.0",
+        "dotenv": "python-dotenv>=1.0.0",
+        "py_clob_client": "py-clob-client>=0.34.0",
+        "websockets": "websockets>=12.0",
+        "numpy": "numpy>=1.24"
     }
     
     missing = []
-    for pkg, req in requirements.items():
-        try:
-            __import__(pkg.replace("-", "_"))  # py-clob-client -> py_clob_client
+    for module, req in requirements.items():
+        pkg = req.split(">=")[0]
+        if importlib.util.find_spec(module) is not None:
             print(f"✅ {pkg} 已安装")
-        except ImportError:
+        else:
             missing.append(req)
             print(f"❌ {pkg} 缺失，将尝试自动安装...")
     
@@ -96,7 +183,9 @@ def install_dependencies():
     requirements = [
         "py-clob-client>=0.34.0",
         "python-dotenv>=1.0.0",
-        "requests>=2.28.0"
+        "httpx>=0.27.0",
+        "websockets>=12.0",
+        "numpy>=1.24"
     ]
     
     try:
@@ -104,7 +193,7 @@ def install_dependencies():
         print("✅ 依赖安装完成！")
     except Exception as e:
         print(f"❌ 安装失败: {e}")
-        print("请尝试在虚拟环境中手动运行: pip install py-clob-client python-dotenv requests")
+        print("请尝试在虚拟环境中手动运行: pip install py-clob-client python-dotenv httpx websockets numpy")
 
 # ==================== 配置 ====================
 def setup_config():
@@ -156,8 +245,9 @@ def setup_config():
         ("MIN_TRADE_USD", "最小交易金额USD (默认5)", "5"),
         ("MAX_TRADE_USD", "最大交易金额USD (默认50)", "50"),
         ("PAPER_MODE", "模拟模式 (true/false，默认true)", "true"),
-        ("SLIPPAGE", "滑点容忍度 (默认0.01)", "0.01"),
-        ("MAX_POSITION", "最大持仓数量 (默认10)", "10"),
+        ("SLIPPAGE", "相对目标成交价的最大滑点 (默认0.01)", "0.01"),
+        ("MAX_WALLET_EXPOSURE_USD", "每个目标钱包最大敞口 USD (默认100, 0为不限)", "100"),
+        ("MAX_TOTAL_EXPOSURE_USD", "总敞口上限 USD (默认500, 0为不限)", "500"),
         ("POLL_INTERVAL", "轮询间隔秒 (默认30，避免rate limit)", "30")
     ]
     
@@ -172,295 +262,3695 @@ def setup_config():
     
     print("\n✅ 配置完成！")
 
+# ==================== 时钟 ====================
+_clock = time.time
+
+def wall_clock() -> float:
+    """当前时间戳；回测时替换为模拟时钟"""
+    return _clock()
+
+def set_clock(func):
+    global _clock
+    _clock = func
+
+# ==================== 指标 ====================
+class Histogram:
+    """固定桶直方图（Prometheus 风格），记录 O(log 桶数)，分位数按桶内线性插值估计"""
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # 秒
+    __slots__ = ("counts", "sum", "count")
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = self.BUCKETS[i - 1] if i else 0.0
+                high = self.BUCKETS[min(i, len(self.BUCKETS) - 1)]
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return 0.0
+
+class _Span:
+    __slots__ = ("metrics", "stage", "wallet", "started")
+    
+    def __init__(self, metrics, stage: str, wallet: str = None):
+        self.metrics = metrics
+        self.stage = stage
+        self.wallet = wallet
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started, self.wallet)
+
+class Metrics:
+    """热路径各阶段耗时和计数器
+    
+    阶段（fetch、diff、market_info、book、sign、post、detect_to_order）按阶段和按钱包各一个直方图；
+    计数器按名称 + 标签累加（跳过原因、错误、HTTP 429 等）。只在事件循环线程里更新，不加锁。
+    METRICS_PORT 上提供 /metrics（Prometheus 文本格式）和 /stats（JSON）。
+    """
+    PREFIX = "polymarket"
+    
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}  # {stage: Histogram}
+        self.wallet_stages = {}  # {(stage, wallet): Histogram}
+        self.counters = {}  # {(name, ((label, value), ...)): n}
+    
+    def observe(self, stage: str, seconds: float, wallet: str = None):
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stages[stage] = Histogram()
+        hist.observe(seconds)
+        if wallet:
+            hist = self.wallet_stages.get((stage, wallet))
+            if hist is None:
+                hist = self.wallet_stages[(stage, wallet)] = Histogram()
+            hist.observe(seconds)
+    
+    def span(self, stage: str, wallet: str = None) -> _Span:
+        """with metrics.span("book"): ... 记录代码块耗时"""
+        return _Span(self, stage, wallet)
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    @staticmethod
+    def _labels(pairs) -> str:
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+    
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        for metric, items in ((f"{self.PREFIX}_stage_seconds", [((("stage", s),), h) for s, h in self.stages.items()]),
+                              (f"{self.PREFIX}_wallet_stage_seconds",
+                               [((("stage", s), ("wallet", w)), h) for (s, w), h in self.wallet_stages.items()])):
+            lines.append(f"# TYPE {metric} histogram")
+            for labels, hist in items:
+                cumulative = 0
+                for bound, n in zip(Histogram.BUCKETS + ("+Inf",), hist.counts):
+                    cumulative += n
+                    lines.append(f"{metric}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{metric}_sum{self._labels(labels)} {hist.sum}")
+                lines.append(f"{metric}_count{self._labels(labels)} {hist.count}")
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {self.PREFIX}_{name}_total counter")
+            for (counter, labels), value in self.counters.items():
+                if counter == name:
+                    lines.append(f"{self.PREFIX}_{name}_total{self._labels(labels)} {value}")
+        lines.append(f"{self.PREFIX}_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    def _describe(hist: Histogram) -> dict:
+        return {"count": hist.count, "p50": hist.quantile(0.5), "p99": hist.quantile(0.99),
+                "mean": hist.sum / hist.count if hist.count else 0.0}
+    
+    def summary(self) -> dict:
+        wallets = {}
+        for (stage, wallet), hist in self.wallet_stages.items():
+            wallets.setdefault(wallet, {})[stage] = self._describe(hist)
+        return {
+            "uptime": time.time() - self.started,
+            "stages": {stage: self._describe(hist) for stage, hist in self.stages.items()},
+            "wallets": wallets,
+            "counters": {f"{name}{self._labels(labels)}": value for (name, labels), value in sorted(self.counters.items())}
+        }
+    
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            path = request.decode("latin-1").split(" ")[1] if request.count(b" ") >= 2 else ""
+            if path.startswith("/metrics"):
+                status, ctype, body = "200 OK", "text/plain; version=0.0.4", self.render()
+            elif path.startswith("/stats"):
+                status, ctype, body = "200 OK", "application/json", json.dumps(self.summary())
+            else:
+                status, ctype, body = "404 Not Found", "text/plain", "not found\n"
+            data = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(data)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"指标请求处理失败: {e}")
+        finally:
+            writer.close()
+    
+    async def serve(self, port: int, host: str = "127.0.0.1"):
+        """启动指标 HTTP 服务，端口被占用时只记警告"""
+        try:
+            server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            logger.warning(f"指标端口 {host}:{port} 启动失败: {e}")
+            return None
+        logger.info(f"📈 指标: http://{host}:{port}/metrics")
+        return server
+
+metrics = Metrics()
+
+def print_stats(port: int = None):
+    """从运行中的机器人拉取 /stats 并打印"""
+    port = port or int(os.getenv("METRICS_PORT", "9108"))
+    try:
+        stats = httpx.get(f"http://127.0.0.1:{port}/stats", timeout=5).json()
+    except Exception as e:
+        print(f"❌ 无法连接指标端口 {port}（机器人是否在运行？）: {e}")
+        return
+    fmt = lambda d: f"n={d['count']:<8d} p50={d['p50'] * 1000:9.1f}ms  p99={d['p99'] * 1000:9.1f}ms"
+    print(f"运行时间: {stats['uptime'] / 60:.1f} 分钟")
+    print("\n阶段耗时:")
+    for stage, desc in stats["stages"].items():
+        print(f"  {stage:16s} {fmt(desc)}")
+    if stats["wallets"]:
+        print("\n按钱包 (fetch p99 最慢的 20 个):")
+        slowest = sorted(stats["wallets"].items(), key=lambda kv: kv[1].get("fetch", {}).get("p99", 0), reverse=True)
+        for wallet, stages in slowest[:20]:
+            print(f"  {wallet[:12]}  " + "  ".join(f"{s}: p50={d['p50'] * 1000:.0f}ms p99={d['p99'] * 1000:.0f}ms"
+                                                 for s, d in stages.items()))
+    if stats["counters"]:
+        print("\n计数:")
+        for name, value in stats["counters"].items():
+            print(f"  {name:50s} {value:g}")
+
+# ==================== 共享 HTTP 客户端 ====================
+def http2_available() -> bool:
+    """是否安装了 h2（httpx 的 HTTP/2 支持）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+class AsyncHTTPClient:
+    """Data API 与 CLOB 共用的连接池 HTTP 客户端
+    
+    keep-alive 连接复用、可配置连接池大小、HTTP/2（已安装 h2 时）、gzip，
+    按接口路径设置超时，并按 host 限制并发请求数，避免阻塞事件循环。
+    """
+    # 按路径前缀设置超时（秒），最长前缀优先
+    DEFAULT_TIMEOUTS = {
+        "/positions": 10,
+        "/trades": 10,
+        "/markets": 5,
+        "/book": 3,
+    }
+    
+    def __init__(self, max_per_host: int = 8, timeout: float = 10, pool_size: int = 20,
+                 keepalive: int = 20, keepalive_expiry: float = 60, http2: bool = None,
+                 endpoint_timeouts: dict = None, recorder=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2_available() if http2 is None else (http2 and http2_available())
+        self.endpoint_timeouts = dict(self.DEFAULT_TIMEOUTS)
+        self.endpoint_timeouts.update(endpoint_timeouts or {})
+        self._client = None
+        self._sync_client = None
+        self._host_limits = {}  # {host: asyncio.Semaphore}
+        self.recorder = recorder  # 设置 RECORD_DIR 时录制所有响应，供回测回放
+    
+    @classmethod
+    def from_env(cls):
+        """从环境变量读取连接池配置"""
+        endpoint_timeouts = {}
+        # 格式: HTTP_TIMEOUTS=/positions=10,/book=3
+        for item in os.getenv("HTTP_TIMEOUTS", "").split(","):
+            if "=" in item:
+                path, value = item.rsplit("=", 1)
+                endpoint_timeouts[path.strip()] = float(value)
+        http2 = os.getenv("HTTP2", "auto").lower()
+        record_dir = os.getenv("RECORD_DIR", "")
+        return cls(
+            max_per_host=int(os.getenv("DATA_API_CONCURRENCY", "8")),
+            timeout=float(os.getenv("HTTP_TIMEOUT", "10")),
+            pool_size=int(os.getenv("HTTP_POOL_SIZE", "20")),
+            keepalive=int(os.getenv("HTTP_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+            http2=None if http2 == "auto" else http2 == "true",
+            endpoint_timeouts=endpoint_timeouts,
+            recorder=ResponseRecorder(record_dir) if record_dir else None
+        )
+    
+    def _client_kwargs(self) -> dict:
+        return {
+            "http2": self.http2,
+            "timeout": self.timeout,
+            "limits": httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.keepalive,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            "headers": {"Accept-Encoding": "gzip", "Connection": "keep-alive"}
+        }
+    
+    def _get_client(self):
+        # 延迟创建，保证在事件循环内初始化
+        if self._client is None:
+            self._client = httpx.AsyncClient(**self._client_kwargs())
+        return self._client
+    
+    def install_clob_transport(self):
+        """让 py_clob_client 的同步请求（下单、撤单）也走同一套连接池配置"""
+        from py_clob_client.http_helpers import helpers as clob_http
+        if self._sync_client is None:
+            self._sync_client = httpx.Client(**self._client_kwargs())
+        clob_http._http_client = self._sync_client
+    
+    def _host_semaphore(self, url: str):
+        host = urlsplit(url).netloc
+        sem = self._host_limits.get(host)
+        if sem is None:
+            sem = asyncio.Semaphore(self.max_per_host)
+            self._host_limits[host] = sem
+        return sem
+    
+    def timeout_for(self, url: str) -> float:
+        """按最长路径前缀匹配接口超时"""
+        path = urlsplit(url).path
+        best, best_len = self.timeout, -1
+        for prefix, value in self.endpoint_timeouts.items():
+            if path.startswith(prefix) and len(prefix) > best_len:
+                best, best_len = value, len(prefix)
+        return best
+    
+    async def get_json(self, url: str, params: dict = None, timeout: float = None):
+        """GET 并解析 JSON，非 2xx 抛出 httpx.HTTPStatusError"""
+        requested_at = wall_clock()
+        async with self._host_semaphore(url):
+            resp = await self._get_client().get(url, params=params, timeout=timeout or self.timeout_for(url))
+        if resp.status_code >= 400:
+            # /markets/<id> 之类的路径只取第一段，避免标签基数爆炸
+            metrics.inc("http_errors", path="/" + urlsplit(url).path.split("/")[1], code=resp.status_code)
+        resp.raise_for_status()
+        body = resp.json()
+        if self.recorder is not None:
+            self.recorder.record(requested_at, url, params, body)
+        return body
+    
+    async def aclose(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+# ==================== 录制与回放 ====================
+class ResponseRecorder:
+    """把 HTTP 响应追加写入按小时切分的 gzip JSON-lines 文件，作为回测数据源
+    
+    文件名 <目录>/<UTC 年月日-时>.<pid>.jsonl.gz 即时间索引，回放时只打开时间范围内的分段；
+    每个进程写自己的文件（分片子进程也会录制），读取时按时间归并。
+    每行 {"t": 请求时间, "url", "params", "body"}。序列化、压缩和写盘都在后台线程，
+    每 RECORD_FLUSH_INTERVAL 秒 flush 一次，进程崩溃最多丢失最后一个间隔的数据。
+    """
+    
+    def __init__(self, directory: str, flush_interval: float = None):
+        self.directory = directory
+        self.flush_interval = flush_interval or float(os.getenv("RECORD_FLUSH_INTERVAL", "5"))
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, name="recorder", daemon=True)
+        self._thread.start()
+    
+    def record(self, ts: float, url: str, params: dict, body):
+        self._queue.put((ts, url, params, body))
+    
+    def _segment_path(self, ts: float) -> str:
+        hour = time.strftime("%Y%m%d-%H", time.gmtime(ts))
+        return os.path.join(self.directory, f"{hour}.{os.getpid()}.jsonl.gz")
+    
+    def _writer(self):
+        out, path = None, None
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    ts, url, params, body = item
+                    segment = self._segment_path(ts)
+                    if segment != path:
+                        if out:
+                            out.close()
+                        out, path = gzip.open(segment, "at", encoding="utf-8"), segment
+                    out.write(json.dumps({"t": ts, "url": url, "params": params, "body": body},
+                                         separators=(",", ":")) + "\n")
+                    self.records += 1
+                if out and time.monotonic() - last_flush >= self.flush_interval:
+                    out.flush()
+                    last_flush = time.monotonic()
+        except Exception as e:
+            logger.error(f"录制写入失败: {e}")
+        finally:
+            if out:
+                out.close()
+    
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+
+def parse_time(value: str) -> float:
+    """时间戳或 ISO 时间（不带时区按 UTC）-> 秒"""
+    try:
+        return float(value)
+    except ValueError:
+        dt = datetime.fromisoformat(value)
+        return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+def recording_segments(directory: str, start: float = None, end: float = None) -> list:
+    """录制分段按小时分组 [(小时起点, [文件...])]，只保留与 [start, end] 相交的小时"""
+    hours = {}
+    for name in os.listdir(directory):
+        if not name.endswith(".jsonl.gz"):
+            continue
+        try:
+            hour = datetime.strptime(name.split(".", 1)[0], "%Y%m%d-%H").replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            continue
+        if (start is not None and hour + 3600 <= start) or (end is not None and hour > end):
+            continue
+        hours.setdefault(hour, []).append(os.path.join(directory, name))
+    return sorted(hours.items())
+
+def _read_segment(path: str):
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+    except (EOFError, OSError, ValueError) as e:
+        # 录制进程崩溃时最后一段可能不完整，读到哪算哪
+        logger.warning(f"录制分段 {path} 不完整: {e}")
+
+def iter_recording(directory: str, start: float = None, end: float = None):
+    """按时间顺序读出录制记录（同一小时多个进程的文件归并）"""
+    for _, paths in recording_segments(directory, start, end):
+        for record in heapq.merge(*(_read_segment(path) for path in paths), key=itemgetter("t")):
+            if (start is None or record["t"] >= start) and (end is None or record["t"] <= end):
+                yield record
+
+class ReplayHTTPClient:
+    """回放录制的响应，接口与 AsyncHTTPClient 相同
+    
+    load() 按时间顺序喂入录制记录；请求返回同一路径、同一参数最近一次录到的响应，
+    页长 limit 不参与匹配，翻页 offset 参与。offset>0 的页没录到时返回空页，
+    其它没录到的请求抛出 LookupError，与线上请求失败走同一条处理路径。
+    """
+    PAGING_PARAMS = ("limit", "offset")
+    
+    def __init__(self):
+        self._latest = {}
+        self.misses = 0
+        self.recorder = None
+    
+    @classmethod
+    def key(cls, url: str, params: dict = None) -> tuple:
+        params = params or {}
+        fixed = tuple(sorted((k, str(v)) for k, v in params.items() if k not in cls.PAGING_PARAMS))
+        return urlsplit(url).path, int(params.get("offset") or 0), fixed
+    
+    def load(self, record: dict):
+        self._latest[self.key(record["url"], record.get("params"))] = record["body"]
+    
+    async def get_json(self, url: str, params: dict = None, timeout: float = None):
+        try:
+            return self._latest[self.key(url, params)]
+        except KeyError:
+            if params and params.get("offset"):
+                return []
+            self.misses += 1
+            raise LookupError(f"回放数据中没有 {urlsplit(url).path} {params or ''}")
+    
+    def timeout_for(self, url: str) -> float:
+        return 0.0
+    
+    def install_clob_transport(self):
+        pass
+    
+    async def aclose(self):
+        pass
+
+# ==================== 事件归一化 ====================
+def trade_record_id(trade: dict):
+    """成交记录的稳定ID
+    
+    Data API /trades 与实时流通常不带 id；同一笔交易哈希下可能有多笔成交，
+    因此用 交易哈希 + token + 方向 + 数量 + 价格 组合，两个来源算出来一致。
+    """
+    if trade.get("id"):
+        return str(trade["id"])
+    tx = trade.get("transactionHash")
+    if not tx:
+        return None
+    token = trade.get("asset") or trade.get("market") or trade.get("conditionId")
+    side = str(trade.get("side", "")).lower()
+    return f"{tx}:{token}:{side}:{float(trade.get('size', 0)):g}:{float(trade.get('price', 0)):g}"
+
+def make_trade_event(wallet: str, token: str, side: str, price: float, size: float, event_id: str,
+                     source: str, timestamp=None, condition_id: str = None, maker: str = "") -> dict:
+    """统一的事件结构，所有来源都转换成它再送入 process_trade"""
+    return {
+        "id": event_id,
+        "wallet": wallet,
+        "market": token,  # 下单用的 token id
+        "condition_id": condition_id,
+        "side": side,
+        "price": price,
+        "size": size,
+        "timestamp": timestamp or datetime.utcnow().isoformat(),
+        "source": source,  # trades / stream / position
+        "taker": wallet,
+        "maker": maker,
+        "detected_at": wall_clock()
+    }
+
+def event_from_trade_record(wallet: str, record: dict, source: str = "trades"):
+    """/trades 或实时流的成交记录 -> 统一事件，无效记录返回 None"""
+    token = record.get("asset") or record.get("market") or record.get("conditionId")
+    price = float(record.get("price", 0))
+    size = float(record.get("size", 0))
+    event_id = trade_record_id(record)
+    if not token or not event_id or price <= 0 or size <= 0:
+        return None
+    return make_trade_event(
+        wallet, token, str(record.get("side", "buy")).lower(), price, size, event_id, source,
+        timestamp=record.get("timestamp"), condition_id=record.get("conditionId"),
+        maker=record.get("maker", "")
+    )
+
+def event_from_position_delta(wallet: str, token: str, price: float, prev_size: float, curr_size: float,
+                              condition_id: str = None) -> dict:
+    """持仓变化 -> 统一事件；ID 由 token 和前后数量决定，同一秒内多次变化也不会冲突"""
+    delta = curr_size - prev_size
+    observed = int(wall_clock())
+    return make_trade_event(
+        wallet, token, "buy" if delta > 0 else "sell", price, abs(delta),
+        f"pos:{token}:{prev_size:g}>{curr_size:g}@{observed}", "position",
+        condition_id=condition_id
+    )
+
+class EventCorrelator:
+    """跨来源关联：成交记录（/trades、实时流）与持仓变化描述的是同一笔成交时只下发一次
+    
+    按 (钱包, token, 方向) 记录时间窗口内已下发的数量：新事件先抵扣另一来源
+    已下发的数量，完全被覆盖则丢弃，部分覆盖则只下发剩余部分。
+    """
+    FILL_SOURCES = ("trades", "stream")
+    
+    def __init__(self, window: float = None, min_size: float = 0.01):
+        self.window = window or float(os.getenv("CORRELATION_WINDOW", "300"))
+        self.min_size = min_size
+        self._emitted = {}  # {(wallet, token, side): {"fill": deque, "position": deque}}，元素为 [过期时间, 剩余数量]
+    
+    def _buckets(self, key, now: float):
+        buckets = self._emitted.setdefault(key, {"fill": deque(), "position": deque()})
+        for bucket in buckets.values():
+            while bucket and bucket[0][0] < now:
+                bucket.popleft()
+        return buckets
+    
+    def correlate(self, event: dict):
+        """返回需要下发的事件（可能数量被缩小），完全重复时返回 None"""
+        now = wall_clock()
+        kind = "fill" if event.get("source") in self.FILL_SOURCES else "position"
+        other = "position" if kind == "fill" else "fill"
+        key = (event.get("wallet") or event.get("taker"), event["market"], event["side"])
+        buckets = self._buckets(key, now)
+        
+        remaining = event["size"]
+        credits = buckets[other]
+        while credits and remaining > self.min_size:
+            used = min(credits[0][1], remaining)
+            credits[0][1] -= used
+            remaining -= used
+            if credits[0][1] <= self.min_size:
+                credits.popleft()
+        
+        if remaining <= self.min_size:
+            logger.debug(f"事件 {event['id']} 已由其它来源下发，跳过")
+            return None
+        if remaining < event["size"]:
+            event = dict(event, size=remaining)
+        buckets[kind].append([now + self.window, remaining])
+        
+        # 清理空键，避免按 token 无限增长
+        if len(self._emitted) > 10000:
+            for stale in [k for k, b in self._emitted.items() if not b["fill"] and not b["position"]]:
+                del self._emitted[stale]
+        return event
+
+# ==================== 去重存储 ====================
+class BloomFilter:
+    """简单的布隆过滤器：bytearray 位图 + 双重哈希"""
+    
+    def __init__(self, bits: int, hashes: int = 4):
+        self.bits = max(8, bits)
+        self.hashes = hashes
+        self.bitmap = bytearray((self.bits + 7) // 8)
+        self.count = 0
+    
+    def _positions(self, h: int):
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+    
+    def add(self, h: int):
+        for pos in self._positions(h):
+            self.bitmap[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+    
+    def __contains__(self, h: int) -> bool:
+        return all(self.bitmap[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(h))
+
+class TradeDedupStore:
+    """有界的时间窗口去重存储，替代只增不减的 set
+    
+    精确层：环形缓冲（64 位哈希 + 时间戳，各 8 字节）加哈希集合，
+    超过 max_items 或 max_age 的最旧记录被淘汰，内存占用保持平稳。
+    缓冲从 1024 条起按需倍增到 max_items，每个钱包一个存储时空闲钱包几乎不占内存。
+    
+    可选布隆过滤器前置（bloom_bits > 0）：被淘汰的记录继续保留两代，
+    每代容量按目标误判率 bloom_fp 计算（默认 0.1%，每条约 2 字节）。
+    误判意味着新成交被当成已处理而漏跟，误判率按需调低、位数相应加大。
+    """
+    INITIAL_CAPACITY = 1024
+    
+    def __init__(self, max_items: int = None, max_age: float = None, bloom_bits: int = None,
+                 bloom_fp: float = None):
+        self.max_items = max_items or int(os.getenv("DEDUP_MAX_ITEMS", "100000"))
+        self.max_age = max_age or float(os.getenv("DEDUP_MAX_AGE", str(7 * 24 * 3600)))
+        self._capacity = min(self.max_items, self.INITIAL_CAPACITY)
+        self._hashes = array("q", bytes(8 * self._capacity))
+        self._times = array("d", bytes(8 * self._capacity))
+        self._head = 0  # 最旧记录的位置
+        self._size = 0
+        self._members = set()
+        bloom_bits = int(os.getenv("DEDUP_BLOOM_BITS", "0")) if bloom_bits is None else bloom_bits
+        bloom_fp = bloom_fp or float(os.getenv("DEDUP_BLOOM_FP", "0.001"))
+        self._bloom_bits = bloom_bits
+        # 查询同时看两代，每代按目标误判率的一半计算容量和哈希个数
+        generation_fp = bloom_fp / 2
+        self._bloom_hashes = max(1, round(-math.log2(generation_fp)))
+        self._bloom_capacity = max(1, int(bloom_bits * math.log(2) ** 2 / -math.log(generation_fp)))
+        self._bloom = BloomFilter(bloom_bits, self._bloom_hashes) if bloom_bits else None
+        self._bloom_prev = None
+    
+    def __len__(self) -> int:
+        return self._size
+    
+    def _evict(self, now: float):
+        cutoff = now - self.max_age
+        while self._size and (self._size >= self.max_items or self._times[self._head] < cutoff):
+            h = self._hashes[self._head]
+            self._members.discard(h)
+            if self._bloom is not None:
+                self._remember(h)
+            self._head = (self._head + 1) % self._capacity
+            self._size -= 1
+    
+    def _grow(self):
+        """缓冲已满且未到 max_items 时容量翻倍，记录按从旧到新重新排到开头"""
+        capacity = min(self.max_items, self._capacity * 2)
+        pad = capacity - self._capacity
+        self._hashes = self._hashes[self._head:] + self._hashes[:self._head] + array("q", bytes(8 * pad))
+        self._times = self._times[self._head:] + self._times[:self._head] + array("d", bytes(8 * pad))
+        self._head = 0
+        self._capacity = capacity
+    
+    def _remember(self, h: int):
+        # 当前代达到容量后整体轮换，旧一代只保留一轮
+        if self._bloom.count >= self._bloom_capacity:
+            self._bloom_prev, self._bloom = self._bloom, BloomFilter(self._bloom_bits, self._bloom_hashes)
+        self._bloom.add(h)
+    
+    def __contains__(self, key: str) -> bool:
+        h = hash(key)  # 进程内 64 位哈希，只存整数不存字符串
+        if h in self._members:
+            return True
+        if self._bloom is not None:
+            return h in self._bloom or (self._bloom_prev is not None and h in self._bloom_prev)
+        return False
+    
+    def add(self, key: str, ts: float = None) -> bool:
+        """记录 key，已存在返回 False"""
+        h = hash(key)  # 进程内 64 位哈希，只存整数不存字符串
+        if h in self._members:
+            return False
+        now = ts or wall_clock()
+        self._evict(now)
+        if self._size == self._capacity:
+            self._grow()
+        tail = (self._head + self._size) % self._capacity
+        self._hashes[tail] = h
+        self._times[tail] = now
+        self._size += 1
+        self._members.add(h)
+        return True
+
+def rss_mb() -> float:
+    """当前进程常驻内存（MB）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_dedup(total: int = 10_000_000, max_items: int = 100_000, bloom_bits: int = 0, bloom_fp: float = 0.001):
+    """去重存储基准：写入 total 个成交ID，观察内存、查询耗时和布隆过滤器误判"""
+    store = TradeDedupStore(max_items=max_items, max_age=float("inf"), bloom_bits=bloom_bits, bloom_fp=bloom_fp)
+    base = rss_mb()
+    print(f"去重存储基准: {total:,} 个ID, 容量 {max_items:,}, 布隆位数 {bloom_bits:,}, 目标误判率 {bloom_fp:g}")
+    print(f"{'已写入':>12} | {'RSS增量(MB)':>12} | {'写入(ns/条)':>12}")
+    checkpoint = max(1, total // 10)
+    start = time.perf_counter()
+    last = start
+    for i in range(total):
+        store.add(f"0x{i:040x}_{i}", ts=i)
+        if (i + 1) % checkpoint == 0:
+            now = time.perf_counter()
+            print(f"{i + 1:>12,} | {rss_mb() - base:>12.1f} | {(now - last) / checkpoint * 1e9:>12.0f}")
+            last = now
+    
+    lookups = min(total, 1_000_000)
+    hit_keys = [f"0x{i:040x}_{i}" for i in range(total - lookups, total)]
+    miss_keys = [f"miss_{i}" for i in range(lookups)]
+    for label, keys in (("命中", hit_keys), ("未命中", miss_keys)):
+        t0 = time.perf_counter()
+        found = sum(1 for key in keys if key in store)
+        elapsed = time.perf_counter() - t0
+        print(f"查询{label}: {elapsed / lookups * 1e9:.0f} ns/次 ({found:,}/{lookups:,} 判定为已处理)")
+    print(f"存储条数: {len(store):,}, 总耗时 {time.perf_counter() - start:.1f}s")
+
+# ==================== 状态持久化 ====================
+class StateStore:
+    """SQLite（WAL 模式）增量保存跟踪器和跟单状态
+    
+    保存目标持仓快照、已见成交ID、跟单账本和市场缓存。写入先在内存合并，
+    flush() 时一个事务批量落盘；重启后直接加载，不会把已有持仓当成新开仓。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS wallets (wallet TEXT PRIMARY KEY, baselined_at REAL);
+        CREATE TABLE IF NOT EXISTS positions (
+            wallet TEXT, token TEXT, data TEXT, PRIMARY KEY (wallet, token)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS seen (
+            scope TEXT, key TEXT, ts REAL, PRIMARY KEY (scope, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS seen_ts ON seen (scope, ts);
+        CREATE TABLE IF NOT EXISTS ledger (
+            account TEXT, wallet TEXT, token TEXT, shares REAL, cost REAL, mark REAL, realized REAL,
+            PRIMARY KEY (account, wallet, token)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS markets (market TEXT PRIMARY KEY, data TEXT, ts REAL);
+        CREATE TABLE IF NOT EXISTS high_water (wallet TEXT PRIMARY KEY, ts REAL);
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")  # 分片进程共用同一个库
+        self.conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._positions = {}  # {(wallet, token): json 或 None(删除)}
+        self._wallets = {}
+        self._seen = []
+        self._ledger = {}  # {(account, wallet, token): (shares, cost, mark, realized)}
+        self._markets = {}
+        self._high_water = {}
+        self._forget = set()  # 待删除全部状态的钱包
+    
+    def _migrate(self):
+        """单账户版本的 ledger 表没有 account 列，整表归到主账户 main"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(ledger)")]
+        if "account" in columns:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("ALTER TABLE ledger RENAME TO ledger_old")
+            self.conn.execute("""CREATE TABLE ledger (
+                account TEXT, wallet TEXT, token TEXT, shares REAL, cost REAL, mark REAL, realized REAL,
+                PRIMARY KEY (account, wallet, token)
+            ) WITHOUT ROWID""")
+            self.conn.execute("INSERT INTO ledger SELECT 'main', * FROM ledger_old")
+            self.conn.execute("DROP TABLE ledger_old")
+    
+    # ---------- 写入（先缓存，flush 时落盘） ----------
+    def mark_baselined(self, wallet: str):
+        self._wallets[wallet] = time.time()
+    
+    def set_positions(self, wallet: str, changed: dict, removed=()):
+        for token, pos in changed.items():
+            self._positions[(wallet, token)] = json.dumps({
+                "size": pos.get("size", 0),
+                "curPrice": pos.get("curPrice", pos.get("price", 0)),
+                "conditionId": pos.get("conditionId")
+            })
+        for token in removed:
+            self._positions[(wallet, token)] = None
+    
+    def add_seen(self, scope: str, key: str, ts: float = None):
+        self._seen.append((scope, key, ts or time.time()))
+    
+    def set_high_water(self, wallet: str, ts: float):
+        self._high_water[wallet] = ts
+    
+    def set_ledger_entry(self, account: str, wallet: str, token: str, entry):
+        self._ledger[(account, wallet, token)] = tuple(entry)
+    
+    def set_market(self, market: str, info: dict, ts: float = None):
+        self._markets[market] = (json.dumps(info), ts or time.time())
+    
+    def forget_wallet(self, wallet: str):
+        """删除一个钱包的基线、持仓快照、已见成交和高水位（不再跟踪时调用）"""
+        scope = f"trades:{wallet}"
+        self._wallets.pop(wallet, None)
+        self._high_water.pop(wallet, None)
+        for key in [key for key in self._positions if key[0] == wallet]:
+            del self._positions[key]
+        self._seen = [item for item in self._seen if item[0] != scope]
+        self._forget.add(wallet)
+    
+    def flush(self):
+        """把缓存的变更在一个事务内写入"""
+        if not (self._positions or self._wallets or self._seen or self._ledger or self._markets
+                or self._high_water or self._forget):
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            # 先删除被移除的钱包，之后缓存里的写入（重新加入后的新基线）再覆盖
+            for wallet in self._forget:
+                self.conn.execute("DELETE FROM wallets WHERE wallet = ?", (wallet,))
+                self.conn.execute("DELETE FROM positions WHERE wallet = ?", (wallet,))
+                self.conn.execute("DELETE FROM high_water WHERE wallet = ?", (wallet,))
+                self.conn.execute("DELETE FROM seen WHERE scope = ?", (f"trades:{wallet}",))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO wallets VALUES (?, ?)", self._wallets.items())
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO positions VALUES (?, ?, ?)",
+                [(w, t, d) for (w, t), d in self._positions.items() if d is not None])
+            self.conn.executemany(
+                "DELETE FROM positions WHERE wallet = ? AND token = ?",
+                [key for key, d in self._positions.items() if d is None])
+            self.conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?, ?)", self._seen)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [key + entry for key, entry in self._ledger.items()])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO markets VALUES (?, ?, ?)",
+                [(m, d, ts) for m, (d, ts) in self._markets.items()])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO high_water VALUES (?, ?)", self._high_water.items())
+        self._positions.clear()
+        self._wallets.clear()
+        self._seen.clear()
+        self._ledger.clear()
+        self._markets.clear()
+        self._high_water.clear()
+        self._forget.clear()
+    
+    # ---------- 读取 ----------
+    def load_baselined(self) -> set:
+        return {row[0] for row in self.conn.execute("SELECT wallet FROM wallets")}
+    
+    def load_positions(self) -> dict:
+        positions = {}
+        for wallet, token, data in self.conn.execute("SELECT wallet, token, data FROM positions"):
+            positions.setdefault(wallet, {})[token] = json.loads(data)
+        return positions
+    
+    def load_seen(self, scope: str) -> list:
+        return self.conn.execute(
+            "SELECT key, ts FROM seen WHERE scope = ? ORDER BY ts", (scope,)).fetchall()
+    
+    def load_high_water(self) -> dict:
+        return dict(self.conn.execute("SELECT wallet, ts FROM high_water"))
+    
+    def load_ledger(self) -> list:
+        """[(account, wallet, token, shares, cost, mark, realized)]"""
+        return self.conn.execute(
+            "SELECT account, wallet, token, shares, cost, mark, realized FROM ledger").fetchall()
+    
+    def load_markets(self) -> dict:
+        """{market: (info, 缓存时间)}"""
+        return {m: (json.loads(d), ts) for m, d, ts in self.conn.execute("SELECT market, data, ts FROM markets")}
+    
+    # ---------- 维护 ----------
+    def compact(self, max_age: float, max_items: int):
+        """删除过期/超量的成交ID并截断 WAL"""
+        self.flush()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM seen WHERE ts < ?", (time.time() - max_age,))
+            scopes = [row[0] for row in self.conn.execute("SELECT DISTINCT scope FROM seen")]
+            for scope in scopes:
+                self.conn.execute(
+                    "DELETE FROM seen WHERE scope = ? AND ts < "
+                    "(SELECT ts FROM seen WHERE scope = ? ORDER BY ts DESC LIMIT 1 OFFSET ?)",
+                    (scope, scope, max_items))
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+# ==================== 向量化持仓对比 ====================
+class TokenIndex:
+    """token id <-> 整数索引，持仓快照里只存整数"""
+    
+    def __init__(self):
+        self._ids = {}
+        self.tokens = []
+    
+    def lookup(self, token: str) -> int:
+        i = self._ids.get(token)
+        if i is None:
+            i = self._ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return i
+
+def position_token(pos: dict):
+    return pos.get("asset") or pos.get("token_id") or pos.get("conditionId")
+
+_POSITION_ASSET = itemgetter("asset")
+_POSITION_SIZE = itemgetter("size")
+
+def _position_columns(positions: list) -> tuple:
+    """取出 (持仓, token, size, price) 四列，跳过没有 token 的持仓"""
+    positions = [pos for pos in positions if position_token(pos)]
+    return (positions,
+            [position_token(pos) for pos in positions],
+            [pos.get("size") or 0 for pos in positions],
+            [pos.get("curPrice", pos.get("price")) or 0 for pos in positions])
+
+class PositionSnapshot:
+    """列式持仓快照：按 token 索引升序排列的 token/size/price 数组
+    
+    与上一次快照的对比用 searchsorted 一次完成，只返回数量变化超过阈值的行。
+    Data API 每次返回的持仓顺序通常不变：token 序列与上一轮相同时直接沿用上一轮的排序，
+    对比时也省掉 searchsorted。原始持仓 dict 只保留引用，condition id 等字段按需读取；
+    价格列只在重估和保存时用到，第一次访问时才构建。
+    """
+    __slots__ = ("tokens", "sizes", "_prices", "_rows", "_order", "_raw")
+    
+    def __init__(self, tokens, sizes, prices, rows: list, order, raw=None):
+        self.tokens = tokens  # int64，升序且唯一
+        self.sizes = sizes  # float64
+        self._prices = prices  # float64，None 表示尚未构建
+        self._rows = rows  # 原始持仓 dict
+        self._order = order  # 第 i 行对应 _rows[_order[i]]
+        self._raw = tokens if raw is None else raw  # 按 _rows 原顺序的 token 索引
+    
+    def __len__(self) -> int:
+        return len(self.tokens)
+    
+    @property
+    def prices(self) -> np.ndarray:
+        if self._prices is None:
+            rows = map(self._rows.__getitem__, self._order.tolist())
+            self._prices = np.fromiter((pos.get("curPrice", pos.get("price")) or 0 for pos in rows),
+                                       np.float64, len(self._order))
+        return self._prices
+    
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, np.int64), np.empty(0), np.empty(0), [], np.empty(0, np.int64))
+    
+    @classmethod
+    def from_positions(cls, positions: list, index: TokenIndex, prev=None):
+        """由 Data API 持仓列表构建（同一 token 出现多次时以最后一条为准）
+        
+        快路径：持仓都带 asset/size 且 token 都已登记时，用 fromiter 直接写入数组，
+        不生成中间列表；有新 token 或字段缺失时走逐行兼容路径。prev 为同一钱包上一轮的快照。
+        """
+        n = len(positions)
+        if not n:
+            return cls.empty()
+        prices = None
+        try:
+            tokens = np.fromiter(map(index._ids.get, map(_POSITION_ASSET, positions)), np.int64, n)
+            sizes = np.fromiter(map(_POSITION_SIZE, positions), np.float64, n)
+            if np.isnan(sizes).any():
+                raise ValueError("missing size")  # fromiter 把 None 转成 nan
+        except (KeyError, TypeError, ValueError):
+            positions, raw_tokens, sizes, prices = _position_columns(positions)
+            if not raw_tokens:
+                return cls.empty()
+            tokens = np.array(list(map(index.lookup, raw_tokens)), dtype=np.int64)
+            sizes = np.array(sizes, dtype=np.float64)
+            prices = np.array(prices, dtype=np.float64)
+        raw = tokens
+        if prev is not None and len(prev._raw) == len(raw) and np.array_equal(prev._raw, raw):
+            order, tokens = prev._order, prev.tokens
+        else:
+            order = np.argsort(raw, kind="stable")
+            tokens = raw[order]
+            if len(tokens) > 1 and not np.all(tokens[1:] != tokens[:-1]):
+                # 有重复 token：稳定排序后每组最后一条即原顺序中的最后一条
+                keep = np.append(tokens[1:] != tokens[:-1], True)
+                order, tokens = order[keep], tokens[keep]
+        return cls(tokens, sizes[order], None if prices is None else prices[order], positions, order, raw)
+    
+    def condition(self, row: int):
+        return self._rows[self._order[row]].get("conditionId")
+    
+    def price(self, row: int) -> float:
+        if self._prices is not None:
+            return float(self._prices[row])
+        pos = self._rows[self._order[row]]
+        return float(pos.get("curPrice", pos.get("price")) or 0)
+    
+    @property
+    def conditions(self) -> list:
+        return [self._rows[i].get("conditionId") for i in self._order.tolist()]
+    
+    @classmethod
+    def from_mapping(cls, mapping: dict, index: TokenIndex):
+        """由 {token: pos} 构建（状态快照恢复用）"""
+        return cls.from_positions([dict(pos, asset=token) for token, pos in mapping.items()], index)
+    
+    def to_mapping(self, index: TokenIndex, rows=None) -> dict:
+        """转成 {token: {size, curPrice, conditionId}}，rows 为空时转换全部行"""
+        rows = range(len(self.tokens)) if rows is None else rows
+        return {
+            index.tokens[self.tokens[i]]: {
+                "size": float(self.sizes[i]),
+                "curPrice": self.price(i),
+                "conditionId": self.condition(i)
+            }
+            for i in rows
+        }
+    
+    def diff(self, prev, threshold: float = 0.01):
+        """返回 (变化行号数组, 对应的之前数量数组)，之前没有的 token 视为 0"""
+        if not len(self.tokens):
+            return np.empty(0, np.int64), np.empty(0)
+        if self.tokens is prev.tokens:
+            prev_sizes = prev.sizes  # 沿用了上一轮的排序，逐行对齐
+        elif len(prev.tokens):
+            at = np.minimum(np.searchsorted(prev.tokens, self.tokens), len(prev.tokens) - 1)
+            prev_sizes = np.where(prev.tokens[at] == self.tokens, prev.sizes[at], 0.0)
+        else:
+            prev_sizes = np.zeros(len(self.tokens))
+        rows = np.flatnonzero(np.abs(self.sizes - prev_sizes) > threshold)
+        return rows, prev_sizes[rows]
+    
+    def price_of(self, tokens) -> np.ndarray:
+        """按 token 索引数组批量取价格，不在快照中的为 nan"""
+        tokens = np.asarray(tokens, dtype=np.int64)
+        if not len(self.tokens):
+            return np.full(len(tokens), np.nan)
+        at = np.minimum(np.searchsorted(self.tokens, tokens), len(self.tokens) - 1)
+        return np.where(self.tokens[at] == tokens, self.prices[at], np.nan)
+    
+    def rows_for(self, tokens) -> list:
+        """按 token 索引取原始持仓 dict（token 必须在快照中）"""
+        at = np.searchsorted(self.tokens, np.asarray(tokens, dtype=np.int64))
+        return [self._rows[i] for i in self._order[at].tolist()]
+    
+    def removed_tokens(self, prev) -> np.ndarray:
+        """之前持有、现在已不在列表中的 token 索引"""
+        return np.setdiff1d(prev.tokens, self.tokens, assume_unique=True)
+
+def _legacy_position_diff(prev_pos: dict, current_pos_list: list) -> tuple:
+    """改造前的逐行对比（仅供基准对照）"""
+    changed = []
+    current_pos_dict = {}
+    for pos in current_pos_list:
+        market_id = pos.get("asset") or pos.get("token_id") or pos.get("conditionId")
+        if not market_id:
+            continue
+        current_pos_dict[market_id] = pos
+        prev = prev_pos.get(market_id, {})
+        curr_size = float(pos.get("size", 0))
+        prev_size = float(prev.get("size", 0))
+        if abs(curr_size - prev_size) > 0.01:
+            changed.append((market_id, prev_size, curr_size))
+    return changed, current_pos_dict
+
+def bench_position_diff(wallets: int = 50, positions: int = 500, cycles: int = 20, change_rate: float = 0.02):
+    """持仓对比基准：逐行 dict 对比 vs 列式快照 + 数组对比"""
+    import random
+    rng = random.Random(1)
+    
+    def make_book(w):
+        return [{"asset": f"{w:04d}{i:072d}", "conditionId": f"0xc{i}", "size": round(rng.uniform(1, 5000), 4),
+                 "curPrice": round(rng.random(), 3), "title": "x" * 40, "outcome": "Yes"} for i in range(positions)]
+    
+    def mutate(book):
+        book = [dict(p) for p in book]
+        for p in book:
+            if rng.random() < change_rate:
+                p["size"] = round(p["size"] + rng.uniform(1, 100), 4)
+        return book
+    
+    frames = []
+    books = [make_book(w) for w in range(wallets)]
+    baseline = books
+    for _ in range(cycles):
+        books = [mutate(book) for book in books]
+        frames.append(books)
+    
+    print(f"持仓对比基准: {wallets} 个钱包 x {positions} 个持仓 x {cycles} 轮, 变化率 {change_rate:.0%}")
+    
+    # 第一轮建立基线（全部是新 token）不计时，只比较稳态轮询
+    prev = [_legacy_position_diff({}, book)[1] for book in baseline]
+    changed_legacy = 0
+    t0 = time.perf_counter()
+    for books in frames:
+        for w, book in enumerate(books):
+            changed, prev[w] = _legacy_position_diff(prev[w], book)
+            changed_legacy += len(changed)
+    legacy = time.perf_counter() - t0
+    
+    index = TokenIndex()
+    snaps = [PositionSnapshot.from_positions(book, index) for book in baseline]
+    changed_vec = 0
+    build = 0.0
+    t0 = time.perf_counter()
+    for books in frames:
+        for w, book in enumerate(books):
+            t1 = time.perf_counter()
+            snap = PositionSnapshot.from_positions(book, index, snaps[w])
+            build += time.perf_counter() - t1
+            rows, _ = snap.diff(snaps[w])
+            changed_vec += len(rows)
+            snaps[w] = snap
+    vectorized = time.perf_counter() - t0
+    
+    per_cycle = lambda t: t / cycles * 1000
+    print(f"逐行对比:   {per_cycle(legacy):8.2f} ms/轮  变化 {changed_legacy}")
+    print(f"列式对比:   {per_cycle(vectorized):8.2f} ms/轮  变化 {changed_vec}  (其中构建快照 {per_cycle(build):.2f} ms)")
+    print(f"纯对比部分: {per_cycle(vectorized - build):8.2f} ms/轮")
+
 # ==================== Data API 跟踪器 ====================
+def trade_timestamp(trade: dict) -> float:
+    """成交时间戳（秒），缺失或无法解析时返回 0"""
+    try:
+        return float(trade.get("timestamp") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
 class DataAPITracker:
     """使用官方 Data API 轮询任意钱包的持仓和交易变化"""
     BASE_URL = "https://data-api.polymarket.com"
+    MISSING_POLLS = 3  # 多页持仓中连续缺失这么多轮才确认 token 已移除
     
-    def __init__(self, target_wallets: list):
+    def __init__(self, target_wallets: list, http: AsyncHTTPClient = None, state: StateStore = None,
+                 limiter=False):
         self.targets = [addr.lower() for addr in target_wallets]
-        self.last_positions = {addr: {} for addr in self.targets}  # {addr: {market_id: pos_info}}
-        self.processed_trade_ids = {addr: set() for addr in self.targets}
+        self.base_url = os.getenv("DATA_API_URL", self.BASE_URL).rstrip("/")  # 本地模拟服务器联调时覆盖
+        # 每个 Data API 请求（含翻页、建立基线和实时流补齐）都从 DATA_API_RPS 预算里取一个令牌；
+        # 不传时按 DATA_API_RPS 新建，分片模式传入跨进程共享的令牌桶，传 None 不限速（回放）
+        self.limiter = RateLimiter(float(os.getenv("DATA_API_RPS", "10"))) if limiter is False else limiter
+        self.token_index = TokenIndex()
+        self.snapshots = {addr: PositionSnapshot.empty() for addr in self.targets}  # {addr: 列式持仓快照}
+        self.processed_trade_ids = {addr: TradeDedupStore() for addr in self.targets}
+        self.baselined = set()  # 已建立持仓基线的地址
+        self.trade_high_water = {addr: 0.0 for addr in self.targets}  # 已处理到的最新成交时间戳
+        self.missing_rows = {}  # {addr: {token 索引: 连续缺失次数}}，多页持仓中暂时沿用上一轮的行
         self.fetch_interval = int(os.getenv("POLL_INTERVAL", "30"))  # 秒
+        self.positions_page_size = int(os.getenv("POSITIONS_PAGE_SIZE", "500"))
+        self.trades_page_min = int(os.getenv("TRADES_PAGE_MIN", "10"))
+        self.trades_page_max = int(os.getenv("TRADES_PAGE_MAX", "500"))
+        self.max_pages = int(os.getenv("MAX_PAGES", "20"))
+        self.http = http or AsyncHTTPClient.from_env()
+        self.state = state
+        if state is not None:
+            self.load_state()
     
-    def fetch_positions(self, address: str) -> list:
-        """获取用户当前持仓"""
-        url = f"{self.BASE_URL}/positions"
-        params = {
-            "user": address,
-            "limit": 200,
-            "sortBy": "TOKENS",
-            "sortDirection": "DESC",
-            "sizeThreshold": 0.01  # 过滤小仓位
-        }
-        try:
-            resp = requests.get(url, params=params, timeout=10)
-            resp.raise_for_status()
-            return resp.json()
-        except Exception as e:
-            logger.error(f"拉取 {address} 持仓失败: {e}")
-            return []
+    def load_state(self):
+        """从快照恢复持仓基线和已见成交ID"""
+        saved_positions = self.state.load_positions()
+        baselined = self.state.load_baselined()
+        high_water = self.state.load_high_water()
+        for addr in self.targets:
+            if addr not in baselined:
+                continue
+            self.baselined.add(addr)
+            self.snapshots[addr] = PositionSnapshot.from_mapping(saved_positions.get(addr, {}), self.token_index)
+            self.trade_high_water[addr] = high_water.get(addr, 0.0)
+            for key, ts in self.state.load_seen(f"trades:{addr}"):
+                self.processed_trade_ids[addr].add(key, ts)
+    
+    def add_wallet(self, addr: str):
+        """开始跟踪一个地址，下一次轮询时先建立基线"""
+        addr = addr.lower()
+        if addr in self.snapshots:
+            return
+        self.targets.append(addr)
+        self.snapshots[addr] = PositionSnapshot.empty()
+        self.processed_trade_ids[addr] = TradeDedupStore()
+        self.trade_high_water[addr] = 0.0
+    
+    def remove_wallet(self, addr: str):
+        """停止跟踪一个地址，释放内存和持久化状态；重新加入时重新建立基线"""
+        addr = addr.lower()
+        if addr not in self.snapshots:
+            return
+        self.targets.remove(addr)
+        del self.snapshots[addr]
+        del self.processed_trade_ids[addr]
+        del self.trade_high_water[addr]
+        self.missing_rows.pop(addr, None)
+        self.baselined.discard(addr)
+        if self.state:
+            self.state.forget_wallet(addr)
+    
+    def _baseline(self, addr: str, current_pos_list: list, trades: list):
+        """首次见到的地址只记录现有持仓和成交，不触发跟单"""
+        snapshot = PositionSnapshot.from_positions(current_pos_list, self.token_index)
+        self.snapshots[addr] = snapshot
+        for trade in trades:
+            trade_id = trade_record_id(trade)
+            if trade_id and self.processed_trade_ids[addr].add(trade_id) and self.state:
+                self.state.add_seen(f"trades:{addr}", trade_id)
+        self._advance_high_water(addr, trades)
+        self.baselined.add(addr)
+        if self.state:
+            self.state.set_positions(addr, snapshot.to_mapping(self.token_index))
+            self.state.mark_baselined(addr)
+        logger.info(f"📌 {addr} 已建立基线: {len(snapshot)} 个持仓, {len(trades)} 笔历史成交（不跟单）")
+    
+    def _advance_high_water(self, addr: str, trades: list):
+        newest = max((trade_timestamp(t) for t in trades), default=0.0)
+        if newest > self.trade_high_water.get(addr, 0.0):
+            self.trade_high_water[addr] = newest
+            if self.state:
+                self.state.set_high_water(addr, newest)
+    
+    async def _get_json(self, url: str, params: dict):
+        if self.limiter is not None:
+            await self.limiter.acquire()
+        return await self.http.get_json(url, params=params)
+    
+    async def fetch_positions(self, address: str) -> list:
+        """获取用户全部持仓，按 offset 翻页（失败时抛出异常，由调用方决定退避）"""
+        url = f"{self.base_url}/positions"
+        positions = []
+        offset = 0
+        for _ in range(self.max_pages):
+            params = {
+                "user": address,
+                "limit": self.positions_page_size,
+                "offset": offset,
+                "sortBy": "TOKENS",
+                "sortDirection": "DESC",
+                "sizeThreshold": 0.01  # 过滤小仓位
+            }
+            page = await self._get_json(url, params)
+            positions.extend(page)
+            if len(page) < self.positions_page_size:
+                return positions
+            offset += len(page)
+        logger.warning(f"{address} 持仓超过 {self.max_pages} 页，只取前 {len(positions)} 个")
+        return positions
 
-    def fetch_recent_trades(self, address: str, limit=50) -> list:
-        """获取最近交易记录（辅助检测新动作）"""
-        url = f"{self.BASE_URL}/trades"
+    async def fetch_recent_trades(self, address: str, limit=50, offset=0) -> list:
+        """获取最近交易记录（按时间倒序）"""
+        url = f"{self.base_url}/trades"
         params = {
             "user": address,
             "limit": limit,
+            "offset": offset,
             "sortBy": "TIMESTAMP",
             "sortDirection": "DESC"
         }
-        try:
-            resp = requests.get(url, params=params, timeout=10)
-            resp.raise_for_status()
-            return resp.json()
-        except Exception as e:
-            logger.error(f"拉取 {address} 最近交易失败: {e}")
-            return []
+        return await self._get_json(url, params)
 
-    async def detect_changes(self, process_trade_func):
-        """检测变化并触发跟单（传入 process_trade 函数）"""
-        async def fetch_for_addr(addr):
-            # 优先用 positions 检测持仓变化
-            current_pos_list = self.fetch_positions(addr)
-            prev_pos = self.last_positions[addr]
-            
-            current_pos_dict = {}
-            for pos in current_pos_list:
-                market_id = pos.get("asset") or pos.get("token_id") or pos.get("conditionId")
-                if not market_id:
+    async def fetch_new_trades(self, address: str) -> list:
+        """增量拉取高水位之后的新成交
+        
+        先拉一小页，整页都是新成交才翻下一页并加大页长；遇到早于高水位的成交即停止，
+        高水位同一秒内的成交按ID去重。空闲钱包每轮只传 TRADES_PAGE_MIN 条。
+        """
+        high_water = self.trade_high_water.get(address, 0.0)
+        seen = self.processed_trade_ids[address]
+        limit = self.trades_page_min
+        offset = 0
+        new_trades = []
+        for _ in range(self.max_pages):
+            page = await self.fetch_recent_trades(address, limit=limit, offset=offset)
+            for trade in page:
+                ts = trade_timestamp(trade)
+                if ts < high_water:
+                    return new_trades
+                if ts == high_water and trade_record_id(trade) in seen:
                     continue
-                current_pos_dict[market_id] = pos
-                
-                prev = prev_pos.get(market_id, {})
-                curr_size = float(pos.get("size", 0))
-                prev_size = float(prev.get("size", 0))
-                
-                if abs(curr_size - prev_size) > 0.01:  # 变化阈值
-                    delta = curr_size - prev_size
-                    if delta > 0:
-                        side = "buy"
-                        action = "加仓/开仓"
-                    else:
-                        side = "sell"
-                        action = "减仓/平仓"
-                    size_change = abs(delta)
-                    price = float(pos.get("curPrice", pos.get("price", 0)))
-                    
-                    # 模拟 trade 对象
-                    simulated_trade = {
-                        "market": market_id,
-                        "side": side,
-                        "price": price,
-                        "size": size_change,
-                        "id": f"pos_change_{int(time.time())}",
-                        "timestamp": datetime.utcnow().isoformat(),
-                        "taker": addr,
-                        "maker": ""
-                    }
-                    
-                    logger.info(f"检测到{action}！{addr} {side.upper()} {size_change:.2f} shares in {market_id}")
-                    await process_trade_func(addr, simulated_trade)
-            
-            self.last_positions[addr] = current_pos_dict
-            
-            # 辅助：检查新 trades
-            trades = self.fetch_recent_trades(addr)
-            for trade in trades:
-                trade_id = trade.get("id")
-                if trade_id not in self.processed_trade_ids[addr]:
-                    self.processed_trade_ids[addr].add(trade_id)
-                    
-                    simulated_trade = {
-                        "market": trade.get("market") or trade.get("conditionId"),
-                        "side": trade.get("side", "buy").lower(),
-                        "price": float(trade.get("price", 0)),
-                        "size": float(trade.get("size", 0)),
-                        "id": trade_id,
-                        "timestamp": trade.get("timestamp"),
-                        "taker": trade.get("taker", addr),
-                        "maker": trade.get("maker", "")
-                    }
-                    
-                    if simulated_trade["price"] > 0 and simulated_trade["size"] > 0:
-                        logger.info(f"检测到新成交！{addr} {simulated_trade['side'].upper()} {simulated_trade['size']:.2f} @ ${simulated_trade['price']:.4f}")
-                        await process_trade_func(addr, simulated_trade)
+                new_trades.append(trade)
+            if len(page) < limit:
+                return new_trades
+            offset += len(page)
+            limit = min(limit * 2, self.trades_page_max)
+        logger.warning(f"{address} 新成交超过 {self.max_pages} 页，可能有遗漏")
+        return new_trades
 
-        # 并行拉取多地址
-        await asyncio.gather(*(fetch_for_addr(addr) for addr in self.targets))
+    async def _fetch_for_baseline(self, addr: str):
+        return await asyncio.gather(self.fetch_positions(addr), self.fetch_recent_trades(addr))
 
-# ==================== REST跟单机器人 ====================
-class RESTCopyTrader:
-    """使用REST API轮询作为主方案"""
-    def __init__(self, client, target_wallets):
-        self.client = client
-        self.target_wallets = [addr.lower().strip() for addr in target_wallets]
+    async def poll_wallet(self, addr: str, process_trade_func) -> int:
+        """轮询单个地址并触发跟单，返回检测到的事件数；拉取失败时抛出异常
         
-        # 配置参数
-        self.trade_multiplier = float(os.getenv("TRADE_MULTIPLIER", "0.5"))
-        self.min_trade_usd = float(os.getenv("MIN_TRADE_USD", "5"))
-        self.max_trade_usd = float(os.getenv("MAX_TRADE_USD", "50"))
-        self.paper_mode = os.getenv("PAPER_MODE", "true").lower() == "true"
-        self.slippage = float(os.getenv("SLIPPAGE", "0.01"))
-        self.max_position = int(os.getenv("MAX_POSITION", "10"))
-        self.poll_interval = int(os.getenv("POLL_INTERVAL", "30"))
+        先下发 /trades 中的新成交（带真实ID和价格），再下发持仓变化；
+        两者对应同一笔成交时由 process_trade 中的 EventCorrelator 合并。
+        """
+        events = 0
+        if addr not in self.baselined:
+            self._baseline(addr, *await self._fetch_for_baseline(addr))
+            return 0
         
-        # 状态跟踪
-        self.processed_trades = set()
-        self.open_positions = {}  # {market_id: size}
+        # 持仓和新成交并发拉取，一个地址的耗时取决于较慢的那个请求
+        with metrics.span("fetch", addr):
+            current_pos_list, trades = await asyncio.gather(
+                self.fetch_positions(addr),
+                self.fetch_new_trades(addr)
+            )
         
-        # Tracker
-        self.tracker = DataAPITracker(self.target_wallets)
+        # 新成交（接口按时间倒序返回，按时间正序下发）
+        for trade in reversed(trades):
+            trade_id = trade_record_id(trade)
+            if not trade_id or not self.processed_trade_ids[addr].add(trade_id):
+                continue
+            if self.state:
+                self.state.add_seen(f"trades:{addr}", trade_id)
+            event = event_from_trade_record(addr, trade, "trades")
+            if event:
+                logger.info("检测到新成交！%s %s %.2f @ $%.4f", addr, event['side'].upper(), event['size'], event['price'])
+                events += 1
+                await process_trade_func(addr, event)
+        self._advance_high_water(addr, trades)
         
-        logger.info(f"REST API跟单机器人初始化")
-        logger.info(f"目标地址: {self.target_wallets}")
-        logger.info(f"轮询间隔: {self.poll_interval}秒")
+        # 持仓变化：列式快照整体对比，只遍历变化的行
+        prev = self.snapshots[addr]
+        with metrics.span("diff", addr):
+            snapshot = PositionSnapshot.from_positions(current_pos_list, self.token_index, prev)
+            snapshot = self._keep_missing_rows(addr, snapshot, prev, len(current_pos_list))
+            rows, prev_sizes = snapshot.diff(prev)
+        for row, prev_size in zip(rows.tolist(), prev_sizes.tolist()):
+            market_id = self.token_index.tokens[snapshot.tokens[row]]
+            curr_size = float(snapshot.sizes[row])
+            event = event_from_position_delta(addr, market_id, snapshot.price(row), prev_size, curr_size,
+                                              condition_id=snapshot.condition(row))
+            action = "加仓/开仓" if event["side"] == "buy" else "减仓/平仓"
+            logger.info("检测到%s！%s %s %.2f shares in %s", action, addr, event['side'].upper(), event['size'], market_id)
+            events += 1
+            await process_trade_func(addr, event)
+        
+        self.snapshots[addr] = snapshot
+        if self.state:
+            removed = [self.token_index.tokens[i] for i in snapshot.removed_tokens(prev).tolist()]
+            self.state.set_positions(addr, snapshot.to_mapping(self.token_index, rows.tolist()), removed)
+        return events
+
+    def _keep_missing_rows(self, addr: str, snapshot, prev, fetched: int):
+        """多页持仓里消失的 token 先沿用上一轮的行
+        
+        持仓按数量排序、按 offset 翻页，翻页期间数量变化会让某行跨过页边界而漏掉；直接当成
+        已移除的话，下一轮再出现时会被当作整仓开仓跟单。连续 MISSING_POLLS 轮都不在才确认移除。
+        只有一页时结果是完整的，不做处理。
+        """
+        missing = snapshot.removed_tokens(prev)
+        if fetched < self.positions_page_size or not len(missing):
+            self.missing_rows.pop(addr, None)
+            return snapshot
+        counts = self.missing_rows.get(addr, {})
+        counts = {token: counts.get(token, 0) + 1 for token in missing.tolist()}
+        keep = [token for token, n in counts.items() if n < self.MISSING_POLLS]
+        self.missing_rows[addr] = {token: counts[token] for token in keep}
+        if not keep:
+            return snapshot
+        logger.debug(f"{addr} 多页持仓中缺少 {len(keep)} 个 token，沿用上一轮的数量")
+        return PositionSnapshot.from_positions(snapshot._rows + prev.rows_for(sorted(keep)), self.token_index)
     
-    async def run(self):
-        """运行REST API轮询"""
-        logger.info("🚀 启动REST API跟单机器人")
-        logger.info(f"模拟模式: {'开启' if self.paper_mode else '关闭'}")
+    def held_condition_ids(self) -> set:
+        """目标当前持有的所有市场 condition id"""
+        return {c for snapshot in self.snapshots.values() for c in snapshot.conditions if c}
+    
+    async def baseline_pending(self):
+        """为还没有基线的地址建立基线（启动时调用，不触发跟单）"""
+        async def baseline(addr):
+            try:
+                self._baseline(addr, *await self._fetch_for_baseline(addr))
+            except Exception as e:
+                logger.error(f"建立 {addr} 基线失败: {e}")
         
-        retry_delay = 5
-        while True:
+        await asyncio.gather(*(baseline(addr) for addr in self.targets if addr not in self.baselined))
+
+    async def detect_changes(self, process_trade_func):
+        """检测所有地址的变化并触发跟单（传入 process_trade 函数）"""
+        async def fetch_for_addr(addr):
             try:
-                await self.tracker.detect_changes(self.process_trade)
-                await asyncio.sleep(self.poll_interval)
+                await self.poll_wallet(addr, process_trade_func)
             except Exception as e:
-                logger.error(f"轮询出错: {e}")
-                await asyncio.sleep(retry_delay)
-                retry_delay = min(retry_delay * 2, 300)  # 指数退避
+                metrics.inc("errors", stage="fetch")
+                logger.error(f"拉取 {addr} 数据失败: {e}")
+
+        # 并行拉取多地址（真正并发，受 DATA_API_CONCURRENCY 限制）
+        await asyncio.gather(*(fetch_for_addr(addr) for addr in self.targets))
+
+# ==================== 自适应轮询调度 ====================
+class RateLimiter:
+    """全局令牌桶：限制每秒请求数"""
     
-    async def process_trade(self, wallet, trade):
-        """处理交易"""
-        try:
-            trade_key = f"{wallet}_{trade['id']}"
-            
-            if trade_key in self.processed_trades:
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+class SharedRateLimiter:
+    """跨进程共享的令牌桶：状态放在共享内存里，所有分片进程共用一个请求预算"""
+    
+    def __init__(self, rate: float, burst: float = None, ctx=None):
+        ctx = ctx or multiprocessing.get_context("spawn")
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._state = ctx.Array("d", [self.burst, time.time()])  # [令牌数, 更新时间]
+    
+    def _try_acquire(self, tokens: float) -> float:
+        """成功返回 0，否则返回需要等待的秒数"""
+        with self._state.get_lock():
+            now = time.time()
+            available = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate)
+            self._state[1] = now
+            if available >= tokens:
+                self._state[0] = available - tokens
+                return 0.0
+            self._state[0] = available
+            return (tokens - available) / self.rate
+    
+    async def acquire(self, tokens: float = 1):
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
                 return
-            
-            self.processed_trades.add(trade_key)
-            
-            market_id = trade['market']
-            # 获取市场信息
-            market_info = self.get_market_info(market_id)
-            market_name = market_info.get('question', '未知市场') if market_info else '未知市场'
-            
-            # 计算跟单
-            price = trade['price']
-            size = trade['size']
-            side = trade['side']
-            
-            usd_value = size * price
-            copy_size = size * self.trade_multiplier
-            copy_usd = copy_size * price
-            
-            # 检查限制
-            if copy_usd < self.min_trade_usd:
-                logger.info(f"💰 金额 {copy_usd:.2f} USD 小于最小限制，跳过")
-                return
-            
-            if copy_usd > self.max_trade_usd:
-                logger.info(f"💰 金额 {copy_usd:.2f} USD 大于最大限制，跳过")
-                return
-            
-            # 检查持仓限制
-            position_key = market_id
-            current_position = self.open_positions.get(position_key, 0)
-            
-            if abs(current_position + (copy_size if side == "buy" else -copy_size)) > self.max_position:
-                logger.info(f"📊 持仓限制 {self.max_position}，跳过")
-                return
-            
-            # 更新持仓 (模拟或真实)
-            if side == "buy":
-                self.open_positions[position_key] = current_position + copy_size
-            else:
-                self.open_positions[position_key] = current_position - copy_size
-            
-            logger.info("="*50)
-            logger.info(f"🎯 检测到目标交易")
-            logger.info(f"  钱包: {wallet[:10]}...")
-            logger.info(f"  市场: {market_name[:50]}...")
-            logger.info(f"  方向: {side.upper()}")
-            logger.info(f"  价格: ${price:.4f}")
-            logger.info(f"  数量: {size:.2f} -> {copy_size:.2f}")
-            logger.info(f"  时间: {trade['timestamp']}")
-            logger.info("="*50)
-            
-            # 执行跟单
-            await self.execute_copy_trade(market_id, side, price, copy_size, market_name)
-            
+            await asyncio.sleep(wait)
+
+class PollScheduler:
+    """按钱包自适应轮询间隔
+    
+    最小堆按下次到期时间排序：有新成交的钱包缩短间隔，空闲的钱包逐步放慢；
+    429/出错只对该钱包退避。DATA_API_RPS 的全局预算由 DataAPITracker 按实际请求数扣减
+    （一次轮询可能翻多页），预算用尽时到期的轮询在令牌桶上排队。
+    """
+    
+    def __init__(self, wallets: list, base_interval: float, min_interval: float = None,
+                 max_interval: float = None):
+        self.base_interval = base_interval
+        self.min_interval = min_interval or float(os.getenv("MIN_POLL_INTERVAL", "5"))
+        self.max_interval = max_interval or float(os.getenv("MAX_POLL_INTERVAL", "300"))
+        self.wallets = {}  # {addr: 调度状态}
+        self._heap = []  # [(next_due, addr)]
+        self._last_report = time.monotonic()
+        now = time.monotonic()
+        for i, addr in enumerate(wallets):
+            # 启动时错开，避免同一时刻打满预算
+            self.add_wallet(addr, now + i * 0.05)
+    
+    def add_wallet(self, addr: str, due: float = None):
+        addr = addr.lower()
+        self.wallets[addr] = {
+            "interval": self.base_interval,
+            "next_due": due or time.monotonic(),
+            "polls": 0,
+            "events": 0,
+            "errors": 0,
+            "reason": "初始"
+        }
+        heapq.heappush(self._heap, (self.wallets[addr]["next_due"], addr))
+    
+    def remove_wallet(self, addr: str):
+        # 堆里的旧项在出堆时跳过
+        self.wallets.pop(addr.lower(), None)
+    
+    def set_base_interval(self, interval: float):
+        """POLL_INTERVAL 变更：所有钱包的间隔重置为新值，之后继续自适应"""
+        self.base_interval = interval
+        for state in self.wallets.values():
+            state["interval"] = interval
+            state["reason"] = "配置更新"
+    
+    def on_result(self, addr: str, events: int):
+        """根据本轮检测到的事件数调整轮询间隔"""
+        state = self.wallets[addr]
+        state["polls"] += 1
+        state["errors"] = 0
+        if events:
+            state["events"] += events
+            state["interval"] = max(self.min_interval, state["interval"] * 0.5)
+            state["reason"] = f"活跃({events}笔)，加快"
+        else:
+            state["interval"] = min(self.max_interval, state["interval"] * 1.25)
+            state["reason"] = "无变化，放慢"
+        return state["interval"]
+    
+    def on_error(self, addr: str, error: Exception):
+        """只对出错的钱包退避；429 优先使用 Retry-After"""
+        state = self.wallets[addr]
+        state["errors"] += 1
+        delay = min(self.max_interval, state["interval"] * (2 ** state["errors"]))
+        response = getattr(error, "response", None)
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            state["reason"] = f"429 限流，退避 {delay:.0f}s"
+        else:
+            state["reason"] = f"出错 {state['errors']} 次，退避 {delay:.0f}s"
+        return delay
+    
+    def snapshot(self) -> list:
+        """当前每个钱包的轮询节奏，便于观察调度决策"""
+        now = time.monotonic()
+        return [
+            {
+                "wallet": addr,
+                "interval": round(state["interval"], 1),
+                "next_in": round(max(0.0, state["next_due"] - now), 1),
+                "polls": state["polls"],
+                "events": state["events"],
+                "errors": state["errors"],
+                "reason": state["reason"]
+            }
+            for addr, state in sorted(self.wallets.items(), key=lambda kv: kv[1]["interval"])
+        ]
+    
+    def report(self, every: int = 300):
+        """定期输出每个钱包的轮询节奏"""
+        if time.monotonic() - self._last_report < every:
+            return
+        self._last_report = time.monotonic()
+        logger.info("📅 轮询节奏:")
+        for item in self.snapshot():
+            logger.info(f"  {item['wallet'][:10]}... 间隔 {item['interval']}s | 轮询 {item['polls']} | 事件 {item['events']} | {item['reason']}")
+    
+    async def _poll(self, addr: str, poll_func, process_trade_func):
+        try:
+            events = await poll_func(addr, process_trade_func)
+            error = None
         except Exception as e:
-            logger.error(f"处理交易失败: {e}")
+            events, error = 0, e
+        state = self.wallets.get(addr)
+        if state is None:
+            return  # 轮询期间已被移除
+        if error is None:
+            delay = self.on_result(addr, events)
+        else:
+            delay = self.on_error(addr, error)
+            metrics.inc("errors", stage="fetch")
+            logger.error(f"拉取 {addr} 数据失败: {error}（{delay:.0f}秒后重试）")
+        state["next_due"] = time.monotonic() + delay
+        heapq.heappush(self._heap, (state["next_due"], addr))
+    
+    async def run(self, poll_func, process_trade_func):
+        """按到期时间依次调度，每个钱包的轮询互不阻塞"""
+        tasks = set()
+        while True:
+            self.report()
+            if not self._heap:
+                await asyncio.sleep(1)
+                continue
+            due, addr = self._heap[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(min(wait, 1))
+                continue
+            heapq.heappop(self._heap)
+            state = self.wallets.get(addr)
+            if state is None or state["next_due"] != due:
+                continue  # 已移除或过期的堆项
+            task = asyncio.create_task(self._poll(addr, poll_func, process_trade_func))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+# ==================== WebSocket 实时流 ====================
+class TradeStream:
+    """订阅实时成交流（RTDS activity/trades），归一化后送入同一个 process_trade
+    
+    断线后指数退避重连（连接收到过消息或稳定保持 stable_after 秒才重置退避，
+    接受连接后立刻断开的服务端不会被每秒重连一次）；重连或检测到序号跳变时标记
+    resync_needed，由 RESTCopyTrader 调用 DataAPITracker 补齐断线期间的成交。
+    """
+    
+    def __init__(self, target_wallets: list, url: str = None):
+        self.targets = {addr.lower() for addr in target_wallets}
+        self.url = url or os.getenv("STREAM_URL", STREAM_URL)
+        self.stable_after = float(os.getenv("STREAM_STABLE_SECS", "30"))
+        self.connected = False
+        self.resync_needed = True  # 启动时先用 REST 建立基线
+        self.state_changed = asyncio.Event()
+        self.last_seq = None
+        self.reconnects = 0
+        self.gaps = 0
     
-    def get_market_info(self, market_id):
-        """获取市场信息"""
+    def subscribe_message(self) -> str:
+        return json.dumps({
+            "action": "subscribe",
+            "subscriptions": [{"topic": "activity", "type": "trades"}]
+        })
+    
+    def _set_connected(self, connected: bool):
+        if self.connected != connected:
+            self.connected = connected
+            self.state_changed.set()
+    
+    def _check_sequence(self, msg: dict):
+        """消息带序号时检测跳变，丢消息后需要 REST 补齐"""
+        seq = msg.get("seq", msg.get("sequence"))
+        if not isinstance(seq, int):
+            return
+        if self.last_seq is not None and seq != self.last_seq + 1:
+            self.gaps += 1
+            self.resync_needed = True
+            self.state_changed.set()
+            logger.warning(f"实时流序号跳变: {self.last_seq} -> {seq}，将用 REST 补齐")
+        self.last_seq = seq
+    
+    def normalize(self, payload: dict):
+        """把实时流成交转成统一事件，非目标钱包返回 None"""
+        wallet = (payload.get("proxyWallet") or payload.get("user") or "").lower()
+        if wallet not in self.targets:
+            return None
+        event = event_from_trade_record(wallet, payload, "stream")
+        return (wallet, event) if event else None
+    
+    async def _handle(self, raw, process_trade_func):
         try:
-            # 使用缓存避免频繁请求
-            if not hasattr(self, '_market_cache'):
-                self._market_cache = {}
-            
-            if market_id in self._market_cache:
-                return self._market_cache[market_id]
-            
-            # 从API获取市场信息
-            market = self.client.get_market(market_id)
-            if market:
-                self._market_cache[market_id] = market
+            msg = json.loads(raw)
+        except (TypeError, ValueError):
+            return  # PONG 等非 JSON 心跳
+        for item in (msg if isinstance(msg, list) else [msg]):
+            if not isinstance(item, dict):
+                continue
+            self._check_sequence(item)
+            if item.get("topic") != "activity":
+                continue
+            payloads = item.get("payload")
+            for payload in (payloads if isinstance(payloads, list) else [payloads]):
+                if not isinstance(payload, dict):
+                    continue
+                normalized = self.normalize(payload)
+                if normalized:
+                    wallet, trade = normalized
+                    logger.info("实时流成交！%s %s %.2f @ $%.4f", wallet, trade['side'].upper(), trade['size'], trade['price'])
+                    await process_trade_func(wallet, trade)
+    
+    async def run(self, process_trade_func):
+        """保持连接并持续消费消息，断线自动重连"""
+        import websockets
+        
+        loop = asyncio.get_running_loop()
+        delay = 1
+        while True:
+            connected_at = None
+            messages = 0
+            try:
+                async with websockets.connect(self.url, ping_interval=10, ping_timeout=10) as ws:
+                    await ws.send(self.subscribe_message())
+                    self.last_seq = None
+                    self._set_connected(True)
+                    connected_at = loop.time()
+                    logger.info(f"📡 实时流已连接: {self.url}")
+                    async for raw in ws:
+                        messages += 1
+                        await self._handle(raw, process_trade_func)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"实时流断开: {e}")
             
-            return market
-        except Exception as e:
-            logger.debug(f"获取市场信息失败 {market_id}: {e}")
+            # 连上就断、没收到任何消息的连接不算恢复，继续加大退避
+            if connected_at is not None and (messages or loop.time() - connected_at >= self.stable_after):
+                delay = 1
+            self.resync_needed = True
+            self._set_connected(False)
+            self.reconnects += 1
+            logger.info(f"{delay}秒后重连实时流，期间使用 REST 轮询")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)  # 指数退避
+
+# ==================== 市场元数据缓存 ====================
+class MarketMetadataCache:
+    """市场元数据缓存
+    
+    LRU + TTL 淘汰（已结算市场不再变化，TTL 更长）；无效ID做负缓存，超时/断连等
+    临时故障做更短的负缓存，避免每个事件都重试；同一市场的并发未命中合并为一次请求；刷新失败时继续用旧值。
+    也用于 order book 的短期缓存（serve_stale=False，过期快照不再使用）。
+    """
+    
+    def __init__(self, fetch_func, max_items: int = None, ttl: float = None,
+                 negative_ttl: float = None, closed_ttl: float = None, on_store=None,
+                 serve_stale: bool = True):
+        self.fetch_func = fetch_func  # async (market_id) -> dict
+        self.max_items = max_items or int(os.getenv("MARKET_CACHE_SIZE", "5000"))
+        self.ttl = ttl or float(os.getenv("MARKET_CACHE_TTL", "600"))
+        self.negative_ttl = negative_ttl or float(os.getenv("MARKET_CACHE_NEGATIVE_TTL", "60"))
+        # 临时故障的负缓存更短，恢复后尽快重新获取
+        self.error_ttl = min(self.negative_ttl, float(os.getenv("MARKET_CACHE_ERROR_TTL", "5")))
+        self.closed_ttl = closed_ttl or 24 * 3600
+        self.on_store = on_store  # 写入回调（持久化）
+        self.serve_stale = serve_stale
+        self._entries = OrderedDict()  # {market_id: (info 或 None, 过期时间)}
+        self._inflight = {}  # {market_id: asyncio.Task}
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _expiry(self, info, fetched_at: float) -> float:
+        if info is None:
+            return fetched_at + self.negative_ttl
+        return fetched_at + (self.closed_ttl if info.get("closed") else self.ttl)
+    
+    def put(self, market_id: str, info, fetched_at: float = None, ttl: float = None):
+        fetched_at = fetched_at or wall_clock()
+        expires = fetched_at + ttl if ttl is not None else self._expiry(info, fetched_at)
+        self._entries[market_id] = (info, expires)
+        self._entries.move_to_end(market_id)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+    
+    def peek(self, market_id: str):
+        """只读缓存：未过期时返回缓存值，否则 None（不计命中、不触发请求）"""
+        entry = self._entries.get(market_id)
+        if entry is not None and entry[1] > wall_clock():
+            return entry[0]
+        return None
+    
+    async def get(self, market_id: str):
+        entry = self._entries.get(market_id)
+        if entry is not None:
+            self._entries.move_to_end(market_id)
+            if entry[1] > wall_clock():
+                self.hits += 1
+                return entry[0]
+        self.misses += 1
+        
+        # 合并并发未命中：同一市场只发一个请求，其余调用等待同一个任务
+        task = self._inflight.get(market_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(market_id, entry))
+            self._inflight[market_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(market_id, None))
+        return await asyncio.shield(task)
+    
+    async def _refresh(self, market_id: str, stale_entry):
+        try:
+            info = await self.fetch_func(market_id) or None
+        except (httpx.HTTPStatusError, httpx.TransportError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (400, 404):
+                info = None  # 无效ID
+            elif self.serve_stale and stale_entry and stale_entry[0] is not None:
+                logger.debug(f"刷新市场信息失败 {market_id}，继续使用旧值: {e}")
+                return stale_entry[0]
+            else:
+                # 临时故障（超时/断连/5xx）且无旧值：短负缓存，不让每次查询都重新打过去
+                logger.debug(f"刷新市场信息失败 {market_id}: {e}")
+                self.put(market_id, None, ttl=self.error_ttl)
+                return None
+        self.put(market_id, info)
+        if info is not None and self.on_store:
+            self.on_store(market_id, info)
+        return info
+    
+    async def prefetch(self, market_ids, concurrency: int = 8):
+        """批量预取（启动时为目标当前持有的所有市场预热）"""
+        market_ids = [m for m in market_ids if m and m not in self._entries]
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def fetch_one(market_id):
+            async with semaphore:
+                try:
+                    await self.get(market_id)
+                except Exception as e:
+                    logger.debug(f"预取市场信息失败 {market_id}: {e}")
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(fetch_one(m) for m in market_ids))
+        if market_ids:
+            logger.info(f"🗂 预取 {len(market_ids)} 个市场信息 ({time.perf_counter() - started:.1f}s)")
+
+# ==================== 深度定价 ====================
+def book_side_levels(book: dict, side: str):
+    """取出吃单方向的价位，按最优价在前排序：买入吃 asks（升序），卖出吃 bids（降序）"""
+    levels = book.get("asks" if side == "buy" else "bids") or []
+    parsed = sorted(
+        ((float(level["price"]), float(level["size"])) for level in levels if float(level["size"]) > 0),
+        reverse=(side != "buy")
+    )
+    return [p for p, _ in parsed], [q for _, q in parsed]
+
+def plan_fill(prices: list, sizes: list, want: float, side: str, max_impact: float, limit: float = None):
+    """按盘口深度计算目标数量的成交均价
+    
+    用累计数量/累计金额的前缀和一次算出各档位结果，二分定位：
+    先按最大冲击（相对最优价）和 limit（可接受的最差价格）截断可用档位，再找到 want 落在哪一档。
+    返回 {size, vwap, limit_price, best, available, impact, levels}，无深度返回 None；
+    最优价已超出 limit 时 size 和 available 为 0。
+    """
+    if not prices or want <= 0:
+        return None
+    best = prices[0]
+    if side == "buy":
+        bound = best * (1 + max_impact) if limit is None else min(best * (1 + max_impact), limit)
+        n = bisect.bisect_right(prices, bound)
+    else:
+        bound = best * (1 - max_impact) if limit is None else max(best * (1 - max_impact), limit)
+        n = bisect.bisect_right([-p for p in prices], -bound)
+    if n == 0:
+        return {"size": 0.0, "vwap": best, "limit_price": best, "best": best, "available": 0.0,
+                "impact": 0.0, "levels": 0}
+    cum_size = list(accumulate(sizes[:n]))
+    cum_notional = list(accumulate(p * q for p, q in zip(prices[:n], sizes[:n])))
+    available = cum_size[-1]
+    fill = min(want, available)
+    i = min(bisect.bisect_left(cum_size, fill), n - 1)
+    before_size = cum_size[i - 1] if i else 0.0
+    before_notional = cum_notional[i - 1] if i else 0.0
+    vwap = (before_notional + (fill - before_size) * prices[i]) / fill
+    return {
+        "size": fill,
+        "vwap": vwap,
+        "limit_price": prices[i],  # 需要吃到的最差价位，作为限价
+        "best": best,
+        "available": available,
+        "impact": abs(vwap - best) / best,
+        "levels": i + 1
+    }
+
+# ==================== 下单执行 ====================
+class OrderExecutor:
+    """独立的下单队列：检测协程只负责入队，不等待签名和提交
+    
+    每个市场一条 FIFO 通道保证同一市场的订单按顺序执行；不同市场并发执行，
+    同时在途的订单数受 MAX_INFLIGHT_ORDERS 限制。EIP-712 签名（CPU 密集）
+    在 SIGNING_WORKERS 线程池中执行，提交订单的阻塞请求在另一个线程池中执行。
+    """
+    
+    def __init__(self, client, max_inflight: int = None, signing_workers: int = None):
+        self.client = client
+        self.max_inflight = max_inflight or int(os.getenv("MAX_INFLIGHT_ORDERS", "4"))
+        signing_workers = signing_workers or int(os.getenv("SIGNING_WORKERS", "2"))
+        self.sign_pool = ThreadPoolExecutor(signing_workers, thread_name_prefix="sign")
+        self.submit_pool = ThreadPoolExecutor(self.max_inflight, thread_name_prefix="submit")
+        self._inflight = None
+        self._lanes = {}  # {market_id: deque[job]}
+        self._tasks = set()
+        self.sign_ms = deque(maxlen=1000)
+        self.submit_ms = deque(maxlen=1000)
+    
+    @property
+    def pending(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+    
+    def submit(self, market_id: str, job):
+        """入队一个下单任务（无参协程函数），立即返回"""
+        lane = self._lanes.get(market_id)
+        if lane is not None:
+            lane.append(job)  # 该市场通道正在执行，排在后面
+            return
+        self._lanes[market_id] = deque([job])
+        task = asyncio.create_task(self._run_lane(market_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run_lane(self, market_id: str):
+        if self._inflight is None:
+            self._inflight = asyncio.Semaphore(self.max_inflight)
+        lane = self._lanes[market_id]
+        try:
+            while lane:
+                job = lane[0]
+                async with self._inflight:
+                    try:
+                        await job()
+                    except Exception as e:
+                        metrics.inc("errors", stage="order")
+                        logger.error(f"❌ 下单任务失败 {market_id}: {e}")
+                lane.popleft()
+        finally:
+            del self._lanes[market_id]
+    
+    @staticmethod
+    def _timed(func, arg):
+        # 在工作线程内计时，不含排队等待线程的时间
+        started = time.perf_counter()
+        result = func(arg)
+        return result, (time.perf_counter() - started) * 1000
+    
+    async def sign(self, order_args):
+        """在签名线程池中创建并签名订单"""
+        loop = asyncio.get_running_loop()
+        signed, elapsed = await loop.run_in_executor(
+            self.sign_pool, self._timed, self.client.create_order, order_args)
+        self.sign_ms.append(elapsed)
+        metrics.observe("sign", elapsed / 1000)
+        return signed
+    
+    async def post(self, signed_order):
+        """在提交线程池中提交订单"""
+        loop = asyncio.get_running_loop()
+        response, elapsed = await loop.run_in_executor(
+            self.submit_pool, self._timed, self.client.post_order, signed_order)
+        self.submit_ms.append(elapsed)
+        metrics.observe("post", elapsed / 1000)
+        return response
+    
+    def timing_summary(self) -> dict:
+        summary = {}
+        for name, values in (("sign", self.sign_ms), ("submit", self.submit_ms)):
+            if values:
+                ordered = sorted(values)
+                summary[name] = {
+                    "count": len(ordered),
+                    "p50": ordered[len(ordered) // 2],
+                    "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+                }
+        return summary
+    
+    async def drain(self, timeout: float = 30):
+        """等待队列中的订单执行完（退出前调用）"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+    
+    def shutdown(self):
+        self.sign_pool.shutdown(wait=False, cancel_futures=True)
+        self.submit_pool.shutdown(wait=False, cancel_futures=True)
+
+# ==================== 订单生命周期 ====================
+class OrderManager:
+    """跟踪已提交的限价单，对账实际成交量
+    
+    每轮只调用一次 get_orders 取回全部挂单；从挂单列表消失的订单（成交完或被撤）才单独
+    查一次最终状态，确认 MATCHED / CANCELED 后才结束跟踪。提交时已全部撮合（status=matched）
+    的订单不进入跟踪。挂单超过 timeout 的一次 cancel_orders 批量撤掉，等下一轮确认最终
+    成交量后，未成交部分交给 on_unfilled（重新定价或释放账本额度）。
+    """
+    TERMINAL_STATUSES = ("MATCHED", "CANCELED", "CANCELED_MARKET_RESOLVED")
+    
+    def __init__(self, client, executor: OrderExecutor, on_unfilled, timeout: float = None,
+                 interval: float = None):
+        self.client = client
+        self.executor = executor  # 阻塞请求在提交线程池中执行
+        self.on_unfilled = on_unfilled  # (订单记录, 未成交数量, 是否超时撤单)
+        self.timeout = timeout or float(os.getenv("ORDER_TIMEOUT", "30"))
+        self.interval = interval or float(os.getenv("ORDER_POLL_INTERVAL", "5"))
+        self.orders = {}  # {order_id: 订单记录}
+    
+    def __len__(self) -> int:
+        return len(self.orders)
+    
+    def track(self, order_id: str, status: str = None, **order):
+        """登记一个已提交的订单（wallet、token、side、price、size 等）
+        
+        status 为提交响应里的状态；matched 表示已全部撮合，直接记为成交，不再轮询。
+        """
+        if (status or "").upper() == "MATCHED":
+            metrics.inc("orders", status="filled")
+            logger.info("✅ 订单成交 %s...: %.2f/%.2f @ $%.4f",
+                        order_id[:10], order["size"], order["size"], order["price"])
+            return
+        order.update(id=order_id, matched=0.0, placed_at=wall_clock(), cancelled=False)
+        self.orders[order_id] = order
+    
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor.submit_pool, func, *args)
+    
+    @staticmethod
+    def _update_matched(order: dict, matched: float):
+        if matched > order["matched"] + 1e-9:
+            logger.info("✅ 订单成交 %s...: %.2f/%.2f @ $%.4f",
+                        order["id"][:10], matched, order["size"], order["price"])
+            order["matched"] = matched
+    
+    def _finish(self, order: dict, matched: float):
+        self._update_matched(order, matched)
+        del self.orders[order["id"]]
+        unfilled = order["size"] - order["matched"]
+        if unfilled <= 0.01:
+            metrics.inc("orders", status="filled")
+            return
+        metrics.inc("orders", status="cancelled" if order["cancelled"] else "closed")
+        logger.info("📭 订单结束 %s...: 成交 %.2f/%.2f", order["id"][:10], order["matched"], order["size"])
+        self.on_unfilled(order, unfilled, order["cancelled"])
+    
+    async def poll(self):
+        """一轮：批量查询挂单，对账成交，撤掉超时订单"""
+        if not self.orders:
+            return
+        # 查询期间新登记的订单可能还没出现在挂单列表里，只对账查询前已登记的
+        tracked = list(self.orders)
+        with metrics.span("order_poll"):
+            open_orders = await self._call(self.client.get_orders)
+        live = {o.get("id"): o for o in open_orders or ()}
+        
+        for order_id in tracked:
+            if order_id in live or order_id not in self.orders:
+                continue
+            try:
+                final = await self._call(self.client.get_order, order_id)
+            except Exception as e:
+                logger.debug("查询订单失败 %s: %s，下一轮重试", order_id, e)
+                continue
+            if not final:
+                continue
+            matched = float(final.get("size_matched") or 0)
+            if str(final.get("status", "")).upper() in self.TERMINAL_STATUSES:
+                self._finish(self.orders[order_id], matched)
+            else:
+                self._update_matched(self.orders[order_id], matched)  # 仍在挂单，下一轮再确认
+        
+        now = wall_clock()
+        stale = []
+        for order_id, status in live.items():
+            order = self.orders.get(order_id)
+            if order is None:
+                continue  # 不是本进程下的单
+            self._update_matched(order, float(status.get("size_matched") or 0))
+            if not order["cancelled"] and now - order["placed_at"] > self.timeout:
+                stale.append(order_id)
+        if stale:
+            response = await self._call(self.client.cancel_orders, stale) or {}
+            for order_id in response.get("canceled") or ():
+                if order_id in self.orders:
+                    self.orders[order_id]["cancelled"] = True
+            logger.info("⌛ 超时撤单 %d 个，未撤成功 %d 个", len(response.get("canceled") or ()),
+                        len(response.get("not_canceled") or ()))
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception as e:
+                metrics.inc("errors", stage="order_poll")
+                logger.error(f"查询订单状态失败: {e}")
+
+# ==================== 多进程分片 ====================
+class ConsistentHashRing:
+    """一致性哈希：把钱包稳定地分配到分片，增减分片时只有少量钱包迁移"""
+    
+    def __init__(self, nodes, vnodes: int = 100):
+        self._ring = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._keys = [h for h, _ in self._ring]
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        # 跨进程稳定（内置 hash() 每个进程都不同）
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+    
+    def node_for(self, key: str):
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+    
+    def partition(self, keys) -> dict:
+        shards = {node: [] for _, node in self._ring}
+        for key in keys:
+            shards[self.node_for(key)].append(key)
+        return shards
+
+def run_shard_worker(shard_id: int, wallets: list, events, limiter, stop):
+    """分片子进程入口：独立事件循环和 DataAPITracker，事件经 IPC 队列发给协调进程"""
+    try:
+        asyncio.run(_shard_main(shard_id, wallets, events, limiter, stop))
+    except KeyboardInterrupt:
+        pass
+
+async def _shard_main(shard_id: int, wallets: list, events, limiter, stop):
+    http = AsyncHTTPClient.from_env()
+    state_path = os.getenv("STATE_DB", "bot_state.db")
+    state = StateStore(state_path) if state_path else None
+    tracker = DataAPITracker(wallets, http=http, state=state, limiter=limiter)
+    scheduler = PollScheduler(tracker.targets, float(os.getenv("POLL_INTERVAL", "30")))
+    
+    async def emit(wallet, event):
+        events.put(("event", wallet, event))
+    
+    logger.info(f"🧩 分片 {shard_id} 启动: {len(wallets)} 个钱包 (pid {os.getpid()})")
+    await tracker.baseline_pending()
+    # 让协调进程预取本分片持有的市场
+    events.put(("markets", sorted(tracker.held_condition_ids())))
+    
+    poller = asyncio.create_task(scheduler.run(tracker.poll_wallet, emit))
+    try:
+        while not stop.is_set():
+            await asyncio.sleep(0.5)
+            if state:
+                state.flush()
+    finally:
+        poller.cancel()
+        if state:
+            state.close()
+        await http.aclose()
+
+def drain_queue(events, max_items: int = 1000, timeout: float = 1.0) -> list:
+    """阻塞等待第一条消息，然后尽量多取一批（在线程池中调用）"""
+    try:
+        batch = [events.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < max_items:
+        try:
+            batch.append(events.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+# ==================== 持仓账本 ====================
+class PositionLedger:
+    """按 (目标钱包, token) 记账：持仓数量、成本、已实现盈亏、最新估值价格
+    
+    跟单成交时增量更新；mark() 按一批最新价格重估。每个钱包和全局的美元敞口
+    （数量 x 估值价）随每次更新同步累加，风控检查只是字典查找。
+    """
+    
+    def __init__(self):
+        self.entries = {}  # {(wallet, token): [数量, 成本, 估值价, 已实现盈亏]}
+        self.holders = {}  # {token: {wallet}}，按 token 重估时用
+        self.wallet_exposure = {}  # {wallet: USD}
+        self.exposure = 0.0  # 全局 USD
+        self.realized = 0.0
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def shares(self, wallet: str, token: str) -> float:
+        entry = self.entries.get((wallet, token))
+        return entry[0] if entry else 0.0
+    
+    def _add_exposure(self, wallet: str, delta: float):
+        self.wallet_exposure[wallet] = self.wallet_exposure.get(wallet, 0.0) + delta
+        self.exposure += delta
+    
+    def load(self, wallet: str, token: str, shares: float, cost: float, mark: float, realized: float):
+        self.entries[(wallet, token)] = [shares, cost, mark, realized]
+        self.holders.setdefault(token, set()).add(wallet)
+        self._add_exposure(wallet, shares * mark)
+        self.realized += realized
+    
+    def apply_fill(self, wallet: str, token: str, side: str, shares: float, price: float) -> list:
+        """记一笔成交（卖出不超过持有数量），返回更新后的条目"""
+        entry = self.entries.get((wallet, token))
+        if entry is None:
+            entry = self.entries[(wallet, token)] = [0.0, 0.0, price, 0.0]
+            self.holders.setdefault(token, set()).add(wallet)
+        old_value = entry[0] * entry[2]
+        if side == "buy":
+            entry[0] += shares
+            entry[1] += shares * price
+        else:
+            shares = min(shares, entry[0])
+            avg_cost = entry[1] / entry[0] if entry[0] else 0.0
+            pnl = shares * (price - avg_cost)
+            entry[0] -= shares
+            entry[1] -= shares * avg_cost
+            entry[3] += pnl
+            self.realized += pnl
+        entry[2] = price
+        self._add_exposure(wallet, entry[0] * price - old_value)
+        return entry
+    
+    def avg_cost(self, wallet: str, token: str):
+        entry = self.entries.get((wallet, token))
+        return entry[1] / entry[0] if entry and entry[0] > 0 else None
+    
+    def release(self, wallet: str, token: str, side: str, shares: float, price: float,
+                avg_cost: float = None) -> list:
+        """撤回 apply_fill 记下但最终没有成交的数量，返回更新后的条目
+        
+        买入按记账价格扣回成本；卖出按卖出时的平均成本（avg_cost，默认当前平均成本）
+        加回持仓并冲回已实现盈亏。
+        """
+        entry = self.entries.get((wallet, token))
+        if entry is None:
             return None
+        old_value = entry[0] * entry[2]
+        if side == "buy":
+            shares = min(shares, entry[0])
+            entry[0] -= shares
+            entry[1] = max(entry[1] - shares * price, 0.0)
+        else:
+            if avg_cost is None:
+                avg_cost = entry[1] / entry[0] if entry[0] else price
+            pnl = shares * (price - avg_cost)
+            entry[0] += shares
+            entry[1] += shares * avg_cost
+            entry[3] -= pnl
+            self.realized -= pnl
+        self._add_exposure(wallet, entry[0] * entry[2] - old_value)
+        return entry
+    
+    def mark(self, prices: dict) -> list:
+        """按 {token: 价格} 批量重估，返回价格有变化的 (wallet, token)"""
+        updated = []
+        for token, price in prices.items():
+            for wallet in self.holders.get(token, ()):
+                entry = self.entries[(wallet, token)]
+                if entry[2] != price:
+                    self._add_exposure(wallet, entry[0] * (price - entry[2]))
+                    entry[2] = price
+                    updated.append((wallet, token))
+        return updated
+    
+    def unrealized(self, wallet: str = None) -> float:
+        return sum(e[0] * e[2] - e[1] for (w, _), e in self.entries.items() if wallet is None or w == wallet)
+    
+    def summary(self) -> dict:
+        """{wallet: {exposure, realized, unrealized, positions}}"""
+        wallets = {}
+        for (wallet, _), (shares, cost, mark, realized) in self.entries.items():
+            item = wallets.setdefault(wallet, {"exposure": 0.0, "realized": 0.0, "unrealized": 0.0, "positions": 0})
+            item["exposure"] += shares * mark
+            item["realized"] += realized
+            item["unrealized"] += shares * mark - cost
+            item["positions"] += shares > 0.01
+        return wallets
+
+def book_mid(book: dict):
+    """盘口中间价，缺一边时返回 None"""
+    bids, _ = book_side_levels(book, "sell")
+    asks, _ = book_side_levels(book, "buy")
+    if not bids or not asks:
+        return None
+    return (bids[0] + asks[0]) / 2
+
+# ==================== 突发成交合并 ====================
+class BurstCoalescer:
+    """把同一 (钱包, 市场, 方向) 短时间内的多笔成交合并成一个跟单意图
     
-    async def execute_copy_trade(self, market_id, side, price, size, market_name):
-        """执行跟单交易"""
+    第一笔到达时开窗，窗口内的后续成交累加数量、价格按数量加权平均；窗口结束后整批
+    交给 flush_func 处理一次（检测时间取第一笔）。第一笔本身 ready（金额已够下单）时
+    立即处理、不等窗口，窗口照样打开，之后的成交合并成窗口结束时的一个尾单：
+    一串成交最多两次下单，首笔延迟不受窗口影响。window <= 0 时逐笔直接透传。
+    """
+    
+    def __init__(self, flush_func, window: float, ready=None):
+        self.flush_func = flush_func  # async (wallet, trade)
+        self.window = window
+        self.ready = ready or (lambda trade: False)
+        self._bursts = {}  # {(wallet, market, side): 合并中的成交}
+        self._timers = {}  # {(wallet, market, side): asyncio.Task}
+    
+    def __len__(self) -> int:
+        return len(self._bursts)
+    
+    async def add(self, wallet: str, trade: dict):
+        if self.window <= 0:
+            await self.flush_func(wallet, trade)
+            return
+        key = (wallet, trade["market"], trade["side"])
+        if key not in self._timers:
+            self._timers[key] = asyncio.create_task(self._flush_later(key))
+            if self.ready(trade):
+                await self.flush_func(wallet, trade)
+                return
+        burst = self._bursts.get(key)
+        if burst is None:
+            self._bursts[key] = dict(trade, fills=1)
+            return
+        size = burst["size"] + trade["size"]
+        if size > 0:
+            burst["price"] = (burst["price"] * burst["size"] + trade["price"] * trade["size"]) / size
+        burst["size"] = size
+        burst["fills"] += 1
+    
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        self._timers.pop(key, None)
+        await self._flush(key)
+    
+    async def _flush(self, key):
+        burst = self._bursts.pop(key, None)
+        if burst is None:
+            return  # 已被另一路（窗口到期或 drain）处理
+        if burst["fills"] > 1:
+            metrics.inc("coalesced", burst["fills"] - 1)
+            logger.info("🧩 合并 %d 笔成交 | 钱包 %s... | %s 数量 %.2f 均价 $%.4f",
+                        burst["fills"], key[0][:10], key[2].upper(), burst["size"], burst["price"])
+        await self.flush_func(key[0], burst)
+    
+    async def drain(self):
+        """不等窗口结束，立即处理全部合并中的成交（退出或回放每轮结束时调用）
+        
+        先取消全部计时器再逐个处理：处理中会等待网络请求，其间不能再有到期的计时器并发处理同一批。
+        """
+        timers, self._timers = self._timers, {}
+        for timer in timers.values():
+            timer.cancel()
+        for key in list(self._bursts):
+            await self._flush(key)
+
+# ==================== 跟单账户 ====================
+def follower_accounts() -> list:
+    """ACCOUNTS 中列出的跟随账户 [(名称, 环境变量前缀)]
+    
+    每个账户用 <名称>_PRIVATE_KEY、<名称>_API_KEY 等带前缀的凭证；跟单参数（如
+    <名称>_TRADE_MULTIPLIER）没有单独配置时沿用主账户的值。
+    """
+    names = [name.strip().lower() for name in os.getenv("ACCOUNTS", "").split(",") if name.strip()]
+    return [(name, name.upper() + "_") for name in dict.fromkeys(names) if name != "main"]
+
+def account_paper_mode(prefix: str = "") -> bool:
+    return (os.getenv(prefix + "PAPER_MODE") or os.getenv("PAPER_MODE", "true")).lower() == "true"
+
+class CopyAccount:
+    """一个下单账户：自己的 CLOB 客户端和凭证、下单队列（含签名线程池）、订单跟踪、账本和跟单参数
+    
+    RESTCopyTrader 只运行一套检测管道，每个事件扇出到全部账户；各账户的签名和提交在各自的
+    线程池里并发执行，互不阻塞。主账户 main 读不带前缀的配置。
+    """
+    # 运行中可热更新的参数：.env 键 -> (属性, 解析函数, 默认值)
+    SETTINGS = {
+        "TRADE_MULTIPLIER": ("trade_multiplier", float, "0.5"),
+        "MIN_TRADE_USD": ("min_trade_usd", float, "5"),
+        "MAX_TRADE_USD": ("max_trade_usd", float, "50"),
+        "SLIPPAGE": ("slippage", float, "0.01"),
+        "MAX_WALLET_EXPOSURE_USD": ("max_wallet_exposure_usd", float, "100"),  # 每个目标钱包，0 为不限
+        "MAX_TOTAL_EXPOSURE_USD": ("max_total_exposure_usd", float, "500"),  # 全部钱包合计，0 为不限
+        "MAX_IMPACT": ("max_impact", float, "0.02"),  # 相对最优价的最大冲击
+        "DEPTH_MODE": ("depth_mode", str.lower, "split"),  # split / skip
+        "DEPTH_MAX_SLICES": ("depth_max_slices", int, "3"),
+        "DEPTH_SPLIT_DELAY": ("depth_split_delay", float, "2"),
+        "ORDER_TIMEOUT": ("order_timeout", float, "30"),  # 挂单超时（秒）后撤单
+        "ORDER_MAX_REPRICES": ("order_max_reprices", int, "1"),  # 撤单后按新盘口重挂的次数，0 为只撤单
+    }
+    # 改了需要重启才生效（跟随账户加前缀）
+    RESTART_KEYS = ("PRIVATE_KEY", "API_KEY", "API_SECRET", "API_PASSPHRASE", "PAPER_MODE")
+    
+    def __init__(self, trader, name: str, client, prefix: str = ""):
+        self.trader = trader  # 共用盘口缓存、状态库和延迟统计
+        self.name = name
+        self.prefix = prefix
+        self.tag = f"[{name}] " if prefix else ""  # 主账户日志不加前缀
+        self.client = client
+        for attr, value in self.read_settings(os.environ, prefix).items():
+            setattr(self, attr, value)
+        self.paper_mode = account_paper_mode(prefix)
+        self.ledger = PositionLedger()  # 按 (目标钱包, token) 记账
+        self.executor = OrderExecutor(client)
+        self.orders = OrderManager(client, self.executor, self._on_unfilled, timeout=self.order_timeout)
+    
+    @classmethod
+    def read_settings(cls, env, prefix: str = "") -> dict:
+        """按 SETTINGS 解析参数（带前缀的键优先），任一值非法时抛出 ValueError"""
+        settings = {}
+        for key, (attr, parse, default) in cls.SETTINGS.items():
+            raw = env.get(prefix + key) or env.get(key) or default
+            try:
+                settings[attr] = parse(raw)
+            except ValueError:
+                raise ValueError(f"{prefix}{key}={raw!r} 格式错误")
+        if settings["depth_mode"] not in ("split", "skip"):
+            raise ValueError(f"{prefix}DEPTH_MODE={settings['depth_mode']!r} 只能是 split 或 skip")
+        return settings
+    
+    def apply_settings(self, settings: dict):
+        for attr, value in settings.items():
+            setattr(self, attr, value)
+        self.orders.timeout = self.order_timeout
+    
+    def copy(self, wallet, trade, market_name):
+        """按一笔（或合并后的）目标成交计算本账户的跟单数量，过风控后入队下单"""
+        market_id = trade['market']
+        price = trade['price']
+        size = trade['size']
+        side = trade['side']
+        
+        copy_size = size * self.trade_multiplier
+        copy_usd = copy_size * price
+        
+        # 检查限制
+        if copy_usd < self.min_trade_usd:
+            metrics.inc("skips", reason="min_usd")
+            logger.info("%s💰 金额 %.2f USD 小于最小限制，跳过", self.tag, copy_usd)
+            return
+        
+        if copy_usd > self.max_trade_usd:
+            metrics.inc("skips", reason="max_usd")
+            logger.info("%s💰 金额 %.2f USD 大于最大限制，跳过", self.tag, copy_usd)
+            return
+        
+        # 检查敞口限制（账本增量维护，直接查表）
+        avg_cost = None
+        if side == "buy":
+            wallet_exposure = self.ledger.wallet_exposure.get(wallet, 0.0)
+            if self.max_wallet_exposure_usd and wallet_exposure + copy_usd > self.max_wallet_exposure_usd:
+                metrics.inc("skips", reason="wallet_exposure")
+                logger.info("%s📊 钱包敞口 %.2f + %.2f USD 超过限制 %.2f，跳过",
+                            self.tag, wallet_exposure, copy_usd, self.max_wallet_exposure_usd)
+                return
+            if self.max_total_exposure_usd and self.ledger.exposure + copy_usd > self.max_total_exposure_usd:
+                metrics.inc("skips", reason="total_exposure")
+                logger.info("%s📊 总敞口 %.2f + %.2f USD 超过限制 %.2f，跳过",
+                            self.tag, self.ledger.exposure, copy_usd, self.max_total_exposure_usd)
+                return
+        else:
+            # 只卖跟这个钱包买入的部分
+            avg_cost = self.ledger.avg_cost(wallet, market_id)
+            held = self.ledger.shares(wallet, market_id)
+            if held <= 0.01:
+                metrics.inc("skips", reason="no_position")
+                logger.info("%s📊 没有跟这个钱包买入的持仓，跳过卖出", self.tag)
+                return
+            copy_size = min(copy_size, held)
+        
+        # 更新账本 (模拟或真实)
+        entry = self.ledger.apply_fill(wallet, market_id, side, copy_size, price)
+        if self.trader.state:
+            self.trader.state.set_ledger_entry(self.name, wallet, market_id, entry)
+        
+        # 一笔一条日志，参数在后台写线程里才格式化；JSON 日志带上结构化字段
+        logger.info("%s🎯 检测到目标交易 | 钱包 %s... | 市场 %s | %s $%.4f | 数量 %.2f -> %.2f | 时间 %s",
+                    self.tag, wallet[:10], market_name[:50], side.upper(), price, size, copy_size, trade['timestamp'],
+                    extra={"account": self.name, "wallet": wallet, "market": market_id, "side": side,
+                           "price": price, "size": size, "copy_size": copy_size, "source": trade.get("source")})
+        
+        # 执行跟单（入队后立即返回，不阻塞检测）
+        self.executor.submit(market_id, functools.partial(
+            self.execute_copy_trade, market_id, side, price, copy_size, market_name,
+            detected_at=trade.get("detected_at"), wallet=wallet, avg_cost=avg_cost))
+    
+    async def execute_copy_trade(self, market_id, side, price, size, market_name, detected_at=None, slice_no=1,
+                                 wallet=None, avg_cost=None, reprices=0, booked=None):
+        """执行跟单交易：按盘口深度定价，超出最大冲击或滑点的部分拆单或跳过
+        
+        限价不超过目标成交价 price 的 (1 ± SLIPPAGE)，最大冲击按当前最优价计算，两者取严。
+        wallet/avg_cost 对应 copy() 记账时的条目，booked 为这部分数量在账本里的记账价格
+        （默认目标成交价）；下出去的数量改按下单价记账，没有下出去的从账本撤回。
+        """
+        booked = booked or price
+        pending = size  # 已记账但还没提交的数量
         try:
-            # 计算调整后的价格（考虑滑点）
-            adjusted_price = price * (1 + self.slippage) if side == "buy" else price * (1 - self.slippage)
+            with metrics.span("book"):
+                book = await self.trader.get_order_book(market_id)
+            prices, sizes = book_side_levels(book, side) if book else ([], [])
+            worst = price * (1 + self.slippage) if side == "buy" else price * (1 - self.slippage)
+            plan = plan_fill(prices, sizes, size, side, self.max_impact, worst)
+            
+            if plan is None:
+                if not self.paper_mode:
+                    metrics.inc("skips", reason="no_book")
+                    logger.warning("%s无法获取order book或盘口无深度，跳过", self.tag)
+                    self.release_unfilled(wallet, market_id, side, size, booked, avg_cost)
+                    return
+                # 模拟模式没有盘口时退回按滑点定价
+                order_price = worst
+                order_size = size
+            else:
+                order_price = plan["limit_price"]
+                order_size = plan["size"]
+                logger.info("  盘口: 最优 $%.4f | 均价 $%.4f | 冲击 %.2f%% | %d 档 | 可成交 %.2f",
+                            plan['best'], plan['vwap'], plan['impact'] * 100, plan['levels'], plan['available'])
+                remaining = size - order_size
+                if remaining > 0.01:
+                    if self.depth_mode == "skip":
+                        metrics.inc("skips", reason="depth")
+                        logger.info("📉 深度不足（需要 %.2f，冲击 %.0f%% 且不差于 $%.4f 内仅 %.2f），跳过",
+                                    size, self.max_impact * 100, worst, plan['available'])
+                        self.release_unfilled(wallet, market_id, side, size, booked, avg_cost)
+                        return
+                    pending = order_size
+                    self._schedule_remainder(market_id, side, price, remaining, market_name, slice_no,
+                                             wallet=wallet, avg_cost=avg_cost, reprices=reprices,
+                                             booked=booked)
+                    if order_size <= 0:
+                        return  # 最优价已超出滑点范围，整单等下一次按新盘口再试
             
             if self.paper_mode:
-                # 模拟交易
-                logger.info(f"[模拟交易] {side.upper()} {market_name[:30]}...")
-                logger.info(f"  数量: {size:.2f} @ ${adjusted_price:.4f}")
-                logger.info(f"  总价: ${size * adjusted_price:.2f}")
-                return {"status": "simulated", "id": f"paper_{int(time.time())}"}
+                self.rebook(wallet, market_id, side, order_size, booked, plan["vwap"] if plan else order_price,
+                            avg_cost)
+                return self.simulate_fill(market_id, side, order_price, order_size, market_name, plan, detected_at)
             else:
-                # 检查深度，避免滑点太大
-                book = self.client.get_order_book(market_id)
-                if not book:
-                    logger.warning("无法获取order book，跳过")
-                    return
-                
                 # 实际交易
-                logger.info(f"📤 执行跟单交易...")
+                logger.info("%s📤 执行跟单交易...", self.tag)
+                
+                from py_clob_client.clob_types import OrderArgs
+                from py_clob_client.order_builder.constants import BUY, SELL
                 
                 # 转换side格式
                 trade_side = BUY if side == "buy" else SELL
                 
-                # 创建订单 (用limit order)
+                # 创建订单 (用limit order，限价为需要吃到的最差档位)
                 order_args = OrderArgs(
                     token_id=market_id,
-                    price=adjusted_price,
-                    size=size,
+                    price=order_price,
+                    size=order_size,
                     side=trade_side
                 )
                 
-                # 提交订单
-                signed_order = self.client.create_order(order_args)
-                response = self.client.post_order(signed_order)
+                # 签名和提交都不在事件循环里执行
+                signed_order = await self.executor.sign(order_args)
+                response = await self.executor.post(signed_order)
+                self.trader.record_latency(detected_at)
+                logger.info("  签名 %.0f ms | 提交 %.0f ms", self.executor.sign_ms[-1], self.executor.submit_ms[-1])
                 
-                if response and response.get("id"):
-                    logger.info(f"✅ 跟单成功！订单ID: {response['id']}")
+                # CLOB 返回 orderID（success=false 时带 errorMsg）
+                order_id = response and response.get("success", True) and (response.get("orderID") or response.get("id"))
+                if order_id:
+                    pending = 0
+                    self.rebook(wallet, market_id, side, order_size, booked, order_price, avg_cost)
+                    metrics.inc("orders", status="accepted")
+                    logger.info("%s✅ 跟单成功！订单ID: %s", self.tag, order_id)
+                    self.orders.track(order_id, status=response.get("status"), wallet=wallet, token=market_id,
+                                      side=side, price=order_price, size=order_size, ref_price=price,
+                                      market_name=market_name, avg_cost=avg_cost, reprices=reprices)
                     return response
                 else:
-                    logger.error(f"❌ 跟单失败: {response}")
+                    metrics.inc("orders", status="rejected")
+                    logger.error(f"{self.tag}❌ 跟单失败: {response}")
+                    self.release_unfilled(wallet, market_id, side, pending, booked, avg_cost)
                     return None
                     
         except Exception as e:
-            logger.error(f"❌ 执行跟单失败: {e}")
+            metrics.inc("errors", stage="execute")
+            logger.error(f"{self.tag}❌ 执行跟单失败: {e}")
+            self.release_unfilled(wallet, market_id, side, pending, booked, avg_cost)
+            return None
+    
+    def release_unfilled(self, wallet, token, side, shares, price, avg_cost=None):
+        """没有成交的数量从账本撤回，释放敞口额度"""
+        if wallet is None or shares <= 0:
+            return
+        entry = self.ledger.release(wallet, token, side, shares, price, avg_cost)
+        if entry is not None and self.trader.state:
+            self.trader.state.set_ledger_entry(self.name, wallet, token, entry)
+    
+    def rebook(self, wallet, token, side, shares, booked, price, avg_cost=None):
+        """已下单的数量从记账价格 booked 改记到实际下单价 price（按原价撤回再按新价记一笔）
+        
+        copy() 按目标成交价预占额度；订单结束时 OrderManager 按 size_matched 对账，
+        未成交部分再按下单价撤回，账本最终等于实际成交数量 x 下单价。
+        """
+        if wallet is None or shares <= 0 or abs(price - booked) < 1e-9:
+            return
+        if self.ledger.release(wallet, token, side, shares, booked, avg_cost) is None:
+            return
+        entry = self.ledger.apply_fill(wallet, token, side, shares, price)
+        if self.trader.state:
+            self.trader.state.set_ledger_entry(self.name, wallet, token, entry)
+    
+    def _on_unfilled(self, order: dict, unfilled: float, timed_out: bool):
+        """订单结束时未成交的部分：超时撤单的按新盘口重挂，否则从账本撤回"""
+        if (timed_out and order["reprices"] < self.order_max_reprices
+                and unfilled * order["ref_price"] >= self.min_trade_usd):
+            logger.info("🔁 剩余 %.2f 按新盘口重新挂单（第 %d 次）", unfilled, order["reprices"] + 1)
+            self.executor.submit(order["token"], functools.partial(
+                self.execute_copy_trade, order["token"], order["side"], order["ref_price"], unfilled,
+                order["market_name"], wallet=order["wallet"], avg_cost=order["avg_cost"],
+                reprices=order["reprices"] + 1, booked=order["price"]))
+            return
+        self.release_unfilled(order["wallet"], order["token"], order["side"], unfilled,
+                              order["price"], order["avg_cost"])
+    
+    def simulate_fill(self, market_id, side, order_price, order_size, market_name, plan=None, detected_at=None):
+        """模拟交易：只记日志，不下单"""
+        metrics.inc("orders", status="simulated")
+        logger.info("%s[模拟交易] %s %s... | 数量 %.2f @ $%.4f | 总价 $%.2f",
+                    self.tag, side.upper(), market_name[:30], order_size, order_price, order_size * order_price)
+        self.trader.record_latency(detected_at)
+        return {"status": "simulated", "id": f"paper_{int(wall_clock())}"}
+    
+    def _schedule_remainder(self, market_id, side, price, remaining, market_name, slice_no,
+                            wallet=None, avg_cost=None, reprices=0, booked=None):
+        """深度不足的剩余部分稍后按新盘口再下一单"""
+        booked = booked or price
+        if slice_no >= self.depth_max_slices:
+            logger.info("📉 已拆 %d 单，剩余 %.2f 放弃", slice_no, remaining)
+            self.release_unfilled(wallet, market_id, side, remaining, booked, avg_cost)
+            return
+        if remaining * price < self.min_trade_usd:
+            logger.info("📉 剩余 %.2f 金额低于最小限制，放弃", remaining)
+            self.release_unfilled(wallet, market_id, side, remaining, booked, avg_cost)
+            return
+        logger.info("📉 深度不足，剩余 %.2f 在 %.0f秒后拆单", remaining, self.depth_split_delay)
+        job = functools.partial(self.execute_copy_trade, market_id, side, price, remaining,
+                                market_name, slice_no=slice_no + 1, wallet=wallet, avg_cost=avg_cost,
+                                reprices=reprices, booked=booked)
+        asyncio.get_running_loop().call_later(self.depth_split_delay, self.executor.submit, market_id, job)
+    
+    def report_ledger(self):
+        """输出账本敞口和盈亏"""
+        if not len(self.ledger):
+            return
+        logger.info(f"📒 {self.tag}账本: 敞口 ${self.ledger.exposure:.2f}, 已实现 ${self.ledger.realized:+.2f}, "
+                    f"未实现 ${self.ledger.unrealized():+.2f}")
+        for wallet, item in self.ledger.summary().items():
+            logger.info(f"📒   {wallet[:10]}... 持仓 {item['positions']} 个, 敞口 ${item['exposure']:.2f}, "
+                        f"已实现 ${item['realized']:+.2f}, 未实现 ${item['unrealized']:+.2f}")
+
+# ==================== REST跟单机器人 ====================
+def parse_wallets(value: str) -> list:
+    return [addr.strip().lower() for addr in (value or "").split(",") if addr.strip()]
+
+class RESTCopyTrader:
+    """使用REST API轮询作为主方案
+    
+    检测管道（轮询/实时流、去重、关联、合并）只有一套，每个事件扇出到全部下单账户：
+    主账户 client 加上 ACCOUNTS 中的跟随账户（clients 按名称传入各自的 CLOB 客户端）。
+    """
+    # 运行中可热更新的检测参数（跟单参数见 CopyAccount.SETTINGS）：.env 键 -> (属性, 解析函数, 默认值)
+    SETTINGS = {
+        "POLL_INTERVAL": ("poll_interval", int, "30"),
+        "COALESCE_WINDOW": ("coalesce_window", float, "2"),  # 合并同一钱包/市场/方向连续成交的窗口（秒），首笔够金额时不等窗口，0 为关闭
+    }
+    # 改了需要重启才生效
+    RESTART_KEYS = ("ACCOUNTS", "INGEST_MODE", "SHARD_WORKERS", "STATE_DB", "CLOB_HOST", "DATA_API_URL")
+    ACCOUNT_CLASS = CopyAccount
+    
+    def __init__(self, client, target_wallets, http: AsyncHTTPClient = None, clients: dict = None,
+                 limiter=False):
+        self.http = http or AsyncHTTPClient.from_env()
+        self.target_wallets = [addr.lower().strip() for addr in target_wallets]
+        
+        # 配置参数
+        for attr, value in self.read_settings(os.environ).items():
+            setattr(self, attr, value)
+        self.ingest_mode = os.getenv("INGEST_MODE", "poll").lower()  # poll / stream
+        self.shard_workers = int(os.getenv("SHARD_WORKERS", "0"))  # >1 时多进程分片轮询
+        self.clob_host = os.getenv("CLOB_HOST", CLOB_HOST).rstrip("/")
+        if os.getenv("MAX_POSITION"):
+            logger.warning("MAX_POSITION 已不再使用，请改用 MAX_WALLET_EXPOSURE_USD / MAX_TOTAL_EXPOSURE_USD")
+        
+        # 下单账户：主账户 + 跟随账户，各自的客户端、签名线程池、账本和跟单参数
+        clients = clients or {}
+        self.accounts = [self.ACCOUNT_CLASS(self, "main", client)] + [
+            self.ACCOUNT_CLASS(self, name, clients.get(name), prefix) for name, prefix in follower_accounts()]
+        self.account = self.accounts[0]
+        self.paper_mode = all(account.paper_mode for account in self.accounts)
+        
+        # 状态跟踪
+        self.processed_trades = TradeDedupStore()
+        self.correlator = EventCorrelator()
+        self.last_prices = {}  # {token: 最近成交价}，下一轮重估时用
+        self.market_cache = MarketMetadataCache(self._fetch_market, on_store=self._store_market)
+        # 同一市场的一串事件复用同一个盘口快照
+        book_ttl = float(os.getenv("BOOK_CACHE_TTL", "1"))
+        self.book_cache = MarketMetadataCache(self._fetch_book, max_items=1000, ttl=book_ttl,
+                                              negative_ttl=book_ttl, serve_stale=False)
+        self.coalescer = BurstCoalescer(self.copy_trade, self.coalesce_window, ready=self.copyable)
+        self.copy_latencies = deque(maxlen=1000)  # 检测→下单延迟（毫秒）
+        self._last_latency_report = time.time()
+        
+        # Tracker
+        # 状态快照（STATE_DB 为空则不持久化）
+        state_path = os.getenv("STATE_DB", "bot_state.db")
+        self.state = StateStore(state_path) if state_path else None
+        if self.state:
+            self.load_state()
+        
+        self.tracker = DataAPITracker(self.target_wallets, http=self.http, state=self.state, limiter=limiter)
+        self.scheduler = PollScheduler(self.target_wallets, self.poll_interval)
+        self.stream = None
+        # 热更新：记下 .env 当前内容，之后只应用有变化的键
+        self.config_path = ENV_FILE
+        self._config_values = dotenv_values(ENV_FILE) if os.path.exists(ENV_FILE) else {}
+        
+        logger.info(f"REST API跟单机器人初始化")
+        logger.info(f"目标地址: {self.target_wallets}")
+        logger.info(f"轮询间隔: {self.poll_interval}秒")
+        if len(self.accounts) > 1:
+            logger.info("下单账户: " + ", ".join(
+                f"{a.name}(x{a.trade_multiplier:g}{', 模拟' if a.paper_mode else ''})" for a in self.accounts))
+        logger.info(f"数据来源: {'实时流 + REST补齐' if self.ingest_mode == 'stream' else 'REST轮询'}")
+    
+    @classmethod
+    def read_settings(cls, env) -> dict:
+        """按 SETTINGS 解析参数，任一值非法时抛出 ValueError"""
+        settings = {}
+        for key, (attr, parse, default) in cls.SETTINGS.items():
+            raw = env.get(key) or default
+            try:
+                settings[attr] = parse(raw)
+            except ValueError:
+                raise ValueError(f"{key}={raw!r} 格式错误")
+        return settings
+    
+    def reload_config(self) -> bool:
+        """重新读取 .env 并应用有变化的键
+        
+        先解析校验全部新值，任一非法则整批不生效；校验通过后在事件循环里同步赋值，
+        不会与轮询、下单交错，跟踪器和跟单参数看到的总是同一版配置。
+        """
+        try:
+            values = dotenv_values(self.config_path)
+        except OSError as e:
+            logger.error(f"读取配置失败: {e}")
+            return False
+        changed = {k: v for k, v in values.items() if v is not None and self._config_values.get(k) != v}
+        if not changed:
+            return False
+        
+        env = dict(os.environ)
+        env.update(changed)
+        try:
+            settings = self.read_settings(env)
+            account_settings = [account.read_settings(env, account.prefix) for account in self.accounts]
+        except ValueError as e:
+            # 不记下这版内容，改正后整批变更重新生效
+            logger.error(f"❌ 配置未生效: {e}")
+            return False
+        
+        self._config_values = values
+        os.environ.update(changed)
+        for attr, value in settings.items():
+            setattr(self, attr, value)
+        for account, new_settings in zip(self.accounts, account_settings):
+            account.apply_settings(new_settings)
+        if self.scheduler.base_interval != self.poll_interval:
+            self.scheduler.set_base_interval(self.poll_interval)
+        self.coalescer.window = self.coalesce_window
+        if "TARGET_WALLETS" in changed:
+            self.set_targets(parse_wallets(changed["TARGET_WALLETS"]))
+        logger.info("🔄 配置已更新: %s", ", ".join(sorted(changed)))
+        restart_keys = set(self.RESTART_KEYS) | {
+            account.prefix + key for account in self.accounts for key in account.RESTART_KEYS}
+        restart = sorted(set(changed) & restart_keys)
+        if restart:
+            logger.warning("⚠️ %s 需要重启才能生效", ", ".join(restart))
+        return True
+    
+    def set_targets(self, targets: list):
+        """增删跟踪的钱包：新钱包下一轮静默建立基线（不跟单），移除的钱包释放全部状态"""
+        wanted = set(targets)
+        added = [addr for addr in targets if addr not in set(self.target_wallets)]
+        removed = [addr for addr in self.target_wallets if addr not in wanted]
+        for addr in added:
+            self.tracker.add_wallet(addr)
+            self.scheduler.add_wallet(addr)
+        for addr in removed:
+            self.tracker.remove_wallet(addr)
+            self.scheduler.remove_wallet(addr)
+        self.target_wallets = list(targets)
+        if self.stream is not None:
+            self.stream.targets = wanted
+        if added or removed:
+            logger.info(f"👛 跟单地址: +{len(added)} -{len(removed)}，共 {len(self.target_wallets)} 个")
+    
+    async def _watch_config(self):
+        """每 CONFIG_RELOAD_INTERVAL 秒检查 .env 修改时间，有变化就热更新"""
+        interval = float(os.getenv("CONFIG_RELOAD_INTERVAL", "5"))
+        mtime = None
+        while True:
+            try:
+                current = os.stat(self.config_path).st_mtime_ns
+            except OSError:
+                current = None
+            if mtime is not None and current is not None and current != mtime:
+                self.reload_config()
+            mtime = current
+            await asyncio.sleep(interval)
+    
+    def load_state(self):
+        """从快照恢复已跟单成交、账本和市场缓存"""
+        started = time.perf_counter()
+        self.state.compact(self.processed_trades.max_age, self.processed_trades.max_items)
+        for key, ts in self.state.load_seen("copied"):
+            self.processed_trades.add(key, ts)
+        accounts = {account.name: account for account in self.accounts}
+        for name, *row in self.state.load_ledger():
+            if name in accounts:
+                accounts[name].ledger.load(*row)
+        for market_id, (info, fetched_at) in self.state.load_markets().items():
+            self.market_cache.put(market_id, info, fetched_at)
+        logger.info(f"💾 已加载状态快照 {self.state.path}: {len(self.processed_trades)} 笔已处理, "
+                    f"{sum(len(account.ledger) for account in self.accounts)} 个持仓, {len(self.market_cache)} 个市场 "
+                    f"({(time.perf_counter() - started) * 1000:.0f} ms)")
+    
+    async def _flush_state_loop(self):
+        """定期把状态变更落盘，每小时压缩一次"""
+        interval = float(os.getenv("STATE_FLUSH_INTERVAL", "1"))
+        last_compact = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.state.flush()
+                if time.monotonic() - last_compact > 3600:
+                    self.state.compact(self.processed_trades.max_age, self.processed_trades.max_items)
+                    last_compact = time.monotonic()
+            except Exception as e:
+                logger.error(f"保存状态失败: {e}")
+    
+    async def run(self):
+        """运行跟单机器人（REST 轮询或实时流模式）"""
+        logger.info("🚀 启动REST API跟单机器人")
+        logger.info(f"模拟模式: {'开启' if self.paper_mode else '关闭'}")
+        
+        flusher = asyncio.create_task(self._flush_state_loop()) if self.state else None
+        metrics_port = int(os.getenv("METRICS_PORT", "9108"))  # 0 为关闭
+        metrics_server = await metrics.serve(metrics_port) if metrics_port else None
+        watcher = asyncio.create_task(self._watch_config())
+        marker = asyncio.create_task(self._mark_loop())
+        order_pollers = [asyncio.create_task(account.orders.run())
+                         for account in self.accounts if not account.paper_mode]
+        try:
+            if self.shard_workers > 1:
+                await self.run_sharded()
+                return
+            await self.prefetch_markets()
+            if self.ingest_mode == "stream":
+                await self.run_stream()
+            else:
+                await self.run_poll()
+        finally:
+            # 先处理合并中的成交、把已入队的订单执行完，再保存状态
+            await self.drain()
+            for account in self.accounts:
+                account.executor.shutdown()
+            if flusher:
+                flusher.cancel()
+                self.state.close()
+            if metrics_server:
+                metrics_server.close()
+            watcher.cancel()
+            marker.cancel()
+            for poller in order_pollers:
+                poller.cancel()
+            await self.http.aclose()
+    
+    async def drain(self):
+        """立即处理合并中的成交，并等待各账户已入队的订单执行完"""
+        await self.coalescer.drain()
+        await asyncio.gather(*(account.executor.drain() for account in self.accounts))
+    
+    async def run_poll(self):
+        """REST API 轮询（按钱包自适应节奏，出错只退避该钱包）"""
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            await self.scheduler.run(self.tracker.poll_wallet, self.process_trade)
+        finally:
+            reporter.cancel()
+    
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(60)
+            self.report_latency()
+            for account in self.accounts:
+                account.report_ledger()
+    
+    def mark_to_market(self) -> list:
+        """用缓存的价格批量重估全部账户的账本，不发请求，返回有变化的 (账户, wallet, token)
+        
+        价格优先级：盘口中间价（book 缓存未过期时）> 目标钱包持仓快照的 curPrice > 最近成交价。
+        """
+        if not any(len(account.ledger) for account in self.accounts):
+            return []
+        prices = self.last_prices
+        self.last_prices = {}
+        # 按钱包分组，每个钱包的持仓快照一次 searchsorted 取完价格
+        groups = {}
+        for account in self.accounts:
+            for wallet, token in account.ledger.entries:
+                groups.setdefault(wallet, set()).add(token)
+        ids = self.tracker.token_index._ids
+        for wallet, tokens in groups.items():
+            snapshot = self.tracker.snapshots.get(wallet)
+            if snapshot is None or not len(snapshot):
+                continue
+            found = [(token, ids[token]) for token in sorted(tokens) if token in ids]
+            if not found:
+                continue
+            marks = snapshot.price_of([i for _, i in found])
+            for (token, _), price in zip(found, marks.tolist()):
+                if price == price:  # 跳过 nan
+                    prices[token] = price
+        for token in {token for account in self.accounts for token in account.ledger.holders}:
+            book = self.book_cache.peek(token)
+            mid = book_mid(book) if book else None
+            if mid is not None:
+                prices[token] = mid
+        return [(account, wallet, token) for account in self.accounts
+                for wallet, token in account.ledger.mark(prices)]
+    
+    async def _mark_loop(self):
+        interval = float(os.getenv("MARK_INTERVAL", "5"))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                updated = self.mark_to_market()
+                if self.state:
+                    for account, wallet, token in updated:
+                        self.state.set_ledger_entry(account.name, wallet, token,
+                                                    account.ledger.entries[(wallet, token)])
+            except Exception as e:
+                logger.error(f"账本重估失败: {e}")
+    
+    async def run_sharded(self):
+        """多进程分片：每个子进程轮询一部分钱包，本进程统一做风控和下单
+        
+        钱包列表热更新后按一致性哈希重新分片，只重启钱包有变化的分片。
+        """
+        ctx = multiprocessing.get_context("spawn")
+        events = ctx.Queue()
+        limiter = SharedRateLimiter(float(os.getenv("DATA_API_RPS", "10")), ctx=ctx)
+        ring = ConsistentHashRing(range(self.shard_workers))
+        workers = {}  # {shard_id: (进程, 停止事件, 钱包列表)}
+        assigned = None
+        
+        def start_worker(shard_id, wallets):
+            stop = ctx.Event()
+            process = ctx.Process(target=run_shard_worker, name=f"shard-{shard_id}", daemon=True,
+                                  args=(shard_id, wallets, events, limiter, stop))
+            process.start()
+            return process, stop, wallets
+        
+        def stop_worker(shard_id):
+            process, stop, _ = workers.pop(shard_id)
+            stop.set()
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        
+        reporter = asyncio.create_task(self._report_loop())
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if assigned != self.target_wallets:
+                    removed = set(assigned or ()) - set(self.target_wallets)
+                    assigned = list(self.target_wallets)
+                    shards = ring.partition(assigned)
+                    changed = [i for i, wallets in shards.items() if wallets != workers.get(i, (None, None, []))[2]]
+                    for shard_id in changed:
+                        if shard_id in workers:
+                            await loop.run_in_executor(None, stop_worker, shard_id)
+                    if self.state:
+                        # 旧分片停下后再删一次，避免它退出前的最后一次落盘把状态写回
+                        for addr in removed:
+                            self.state.forget_wallet(addr)
+                    for shard_id in changed:
+                        if shards[shard_id]:
+                            workers[shard_id] = start_worker(shard_id, shards[shard_id])
+                    logger.info(f"🧩 {len(workers)} 个分片进程（重启 {len(changed)} 个）: "
+                                + ", ".join(f"#{i}={len(workers[i][2])}个钱包" for i in sorted(workers)))
+                
+                batch = await loop.run_in_executor(None, drain_queue, events)
+                targets = set(self.target_wallets)
+                for message in batch:
+                    if message[0] == "event" and message[1] in targets:
+                        await self.process_trade(message[1], message[2])
+                    elif message[0] == "markets":
+                        asyncio.create_task(self.market_cache.prefetch(message[1]))
+                for shard_id, (process, _, wallets) in list(workers.items()):
+                    if not process.is_alive():
+                        logger.error(f"分片 {shard_id} 退出 (code {process.exitcode})，重启")
+                        workers[shard_id] = start_worker(shard_id, wallets)
+        finally:
+            reporter.cancel()
+            for shard_id in list(workers):
+                stop_worker(shard_id)
+    
+    async def run_stream(self):
+        """实时流为主；断线或序号跳变时退回 DataAPITracker 轮询补齐"""
+        stream = self.stream = TradeStream(self.target_wallets)
+        stream_task = asyncio.create_task(stream.run(self.process_trade))
+        try:
+            while True:
+                if not stream.connected or stream.resync_needed:
+                    stream.resync_needed = False
+                    try:
+                        await self.tracker.detect_changes(self.process_trade)
+                    except Exception as e:
+                        logger.error(f"REST 补齐出错: {e}")
+                self.report_latency()
+                # 已连接时只在状态变化时醒来；断线时按轮询间隔继续 REST 轮询
+                stream.state_changed.clear()
+                try:
+                    await asyncio.wait_for(stream.state_changed.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            stream_task.cancel()
+    
+    def record_latency(self, detected_at):
+        """记录从检测到下单完成的延迟"""
+        if not detected_at:
+            return
+        latency_ms = (wall_clock() - detected_at) * 1000
+        self.copy_latencies.append(latency_ms)
+        metrics.observe("detect_to_order", latency_ms / 1000)
+        logger.info("⏱ 检测→下单延迟: %.0f ms", latency_ms)
+    
+    def latency_summary(self) -> dict:
+        if not self.copy_latencies:
+            return {}
+        values = sorted(self.copy_latencies)
+        return {
+            "count": len(values),
+            "p50": values[len(values) // 2],
+            "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+            "max": values[-1]
+        }
+    
+    def report_latency(self, every: int = 60):
+        """定期输出延迟统计"""
+        if time.time() - self._last_latency_report < every:
+            return
+        self._last_latency_report = time.time()
+        summary = self.latency_summary()
+        if summary:
+            logger.info(f"⏱ 延迟统计(最近{summary['count']}笔): p50={summary['p50']:.0f}ms p99={summary['p99']:.0f}ms max={summary['max']:.0f}ms")
+        for account in self.accounts:
+            for stage, stats in account.executor.timing_summary().items():
+                label = "签名" if stage == "sign" else "提交"
+                logger.info(f"⏱ {account.tag}{label}耗时(最近{stats['count']}笔): "
+                            f"p50={stats['p50']:.0f}ms p99={stats['p99']:.0f}ms")
+    
+    async def process_trade(self, wallet, trade):
+        """处理交易：去重、关联后交给合并窗口，窗口结束再统一跟单"""
+        try:
+            trade_key = f"{wallet}_{trade['id']}"
+            
+            if not self.processed_trades.add(trade_key):
+                metrics.inc("skips", reason="duplicate")
+                return
+            if self.state:
+                self.state.add_seen("copied", trade_key)
+            
+            # 同一笔成交可能同时以成交记录和持仓变化出现，只处理一次
+            trade = self.correlator.correlate(dict(trade, wallet=wallet))
+            if trade is None:
+                metrics.inc("skips", reason="correlated")
+                return
+            metrics.inc("events", source=trade.get("source", "unknown"))
+            await self.coalescer.add(wallet, trade)
+            
+        except Exception as e:
+            metrics.inc("errors", stage="process_trade")
+            logger.error(f"处理交易失败: {e}")
+    
+    def copyable(self, trade) -> bool:
+        """按每个账户的倍数都已达到 MIN_TRADE_USD，合并器不必再等后续碎单"""
+        usd = trade["size"] * trade["price"]
+        return all(usd * account.trade_multiplier >= account.min_trade_usd for account in self.accounts)
+    
+    async def copy_trade(self, wallet, trade):
+        """一笔（或合并后的）目标成交：查一次市场信息，扇出到每个下单账户各自计算和下单"""
+        try:
+            market_id = trade['market']
+            self.last_prices[market_id] = trade['price']
+            # 获取市场信息（CLOB /markets 按 condition id 查询）
+            with metrics.span("market_info"):
+                market_info = await self.get_market_info(trade.get('condition_id') or market_id)
+            market_name = market_info.get('question', '未知市场') if market_info else '未知市场'
+        except Exception as e:
+            metrics.inc("errors", stage="copy_trade")
+            logger.error(f"处理交易失败: {e}")
+            return
+        for account in self.accounts:
+            try:
+                account.copy(wallet, trade, market_name)
+            except Exception as e:
+                metrics.inc("errors", stage="copy_trade")
+                logger.error(f"{account.tag}处理交易失败: {e}")
+    
+    async def _fetch_market(self, market_id):
+        return await self.http.get_json(f"{self.clob_host}/markets/{market_id}")
+    
+    async def _fetch_book(self, token_id):
+        return await self.http.get_json(f"{self.clob_host}/book", params={"token_id": token_id})
+    
+    async def get_order_book(self, token_id):
+        try:
+            return await self.book_cache.get(token_id)
+        except Exception as e:
+            logger.debug("获取 order book 失败 %s: %s", token_id, e)
             return None
+    
+    def _store_market(self, market_id, info):
+        if self.state:
+            self.state.set_market(market_id, info)
+    
+    async def get_market_info(self, market_id):
+        """获取市场信息（带缓存，走共享连接池）"""
+        try:
+            return await self.market_cache.get(market_id)
+        except Exception as e:
+            logger.debug("获取市场信息失败 %s: %s", market_id, e)
+            return None
+    
+    async def prefetch_markets(self):
+        """为目标当前持有的所有市场预取元数据，首笔跟单不用冷查询"""
+        await self.tracker.baseline_pending()
+        await self.market_cache.prefetch(self.tracker.held_condition_ids())
+    
+# ==================== 回测 ====================
+class BacktestAccount(CopyAccount):
+    """回放用的下单账户：模拟成交记入账本，不下真实订单
+    
+    成交价取盘口计划的均价（没有录到盘口时取限价）；深度不足的剩余部分直接放弃，
+    回放中没有之后的盘口可以拆单。
+    """
+    
+    def __init__(self, trader, name, client, prefix=""):
+        super().__init__(trader, name, client, prefix)
+        self.holdings = {}  # {token: [数量, 成本]}
+        self.realized = 0.0
+        self.fills = 0
+        self.volume = 0.0
+        self.dropped = 0.0  # 因深度不足放弃的数量
+    
+    def simulate_fill(self, market_id, side, order_price, order_size, market_name, plan=None, detected_at=None):
+        price = plan["vwap"] if plan else order_price
+        held = self.holdings.setdefault(market_id, [0.0, 0.0])
+        if side == "buy":
+            held[0] += order_size
+            held[1] += order_size * price
+        else:
+            # 不能卖空，只卖出已持有的部分
+            order_size = min(order_size, held[0])
+            if order_size <= 0:
+                return None
+            avg_cost = held[1] / held[0]
+            self.realized += order_size * (price - avg_cost)
+            held[0] -= order_size
+            held[1] -= order_size * avg_cost
+        self.fills += 1
+        self.volume += order_size * price
+        return {"status": "simulated", "id": f"backtest_{self.fills}"}
+    
+    def _schedule_remainder(self, market_id, side, price, remaining, market_name, slice_no,
+                            wallet=None, avg_cost=None, reprices=0, booked=None):
+        self.dropped += remaining
+        self.release_unfilled(wallet, market_id, side, remaining, booked or price, avg_cost)
+    
+    def summary(self, marks: dict) -> dict:
+        exposure = unrealized = 0.0
+        for token, (size, cost) in self.holdings.items():
+            if size > 1e-9:
+                value = size * marks.get(token, cost / size)
+                exposure += value
+                unrealized += value - cost
+        return {
+            "fills": self.fills,
+            "volume": self.volume,
+            "realized": self.realized,
+            "unrealized": unrealized,
+            "pnl": self.realized + unrealized,
+            "exposure": exposure,
+            "dropped": self.dropped
+        }
+
+class BacktestTrader(RESTCopyTrader):
+    """回放用的跟单机器人：只回放主账户，未平仓持仓按最后观测到的目标成交价估值"""
+    ACCOUNT_CLASS = BacktestAccount
+    
+    def __init__(self, target_wallets, http):
+        super().__init__(None, target_wallets, http=http, limiter=None)  # 回放不限速
+        self.marks = {}  # {token: 最近观测价格}
+    
+    async def process_trade(self, wallet, trade):
+        self.marks[trade["market"]] = trade["price"]
+        await super().process_trade(wallet, trade)
+    
+    def summary(self) -> dict:
+        return self.account.summary(self.marks)
+
+async def run_backtest(directory: str, overrides: dict = None, start: float = None, end: float = None) -> dict:
+    """用录制数据回放一遍检测和跟单逻辑，返回成交和盈亏汇总
+    
+    overrides 覆盖 .env 中的参数（TRADE_MULTIPLIER、MAX_WALLET_EXPOSURE_USD 等）；TARGET_WALLETS 非空时
+    只回放这些钱包，否则回放录到的全部钱包。时钟换成模拟时钟，每次 /positions 首页的
+    录制时间即一次轮询；轮询前先装入之后 REPLAY_LOOKAHEAD 秒内的记录（同一轮的成交和盘口）。
+    模拟时钟下不等合并窗口，每轮轮询结束时合并该轮的成交。
+    """
+    overrides = overrides or {}
+    os.environ.update({key: str(value) for key, value in overrides.items()})
+    os.environ.update(PAPER_MODE="true", STATE_DB="", ACCOUNTS="")
+    logger.setLevel(logging.WARNING)  # 回放时不输出逐笔日志
+    now = [start or 0.0]
+    set_clock(lambda: now[0])
+    lookahead = float(os.getenv("REPLAY_LOOKAHEAD", "2"))
+    only = {addr.strip().lower() for addr in os.getenv("TARGET_WALLETS", "").split(",") if addr.strip()}
+    
+    http = ReplayHTTPClient()
+    trader = BacktestTrader([], http)
+    tracker = trader.tracker
+    polls = deque()  # [(时间, 钱包)]
+    stats = {"records": 0, "polls": 0, "events": 0, "errors": 0}
+    started = time.perf_counter()
+    
+    async def poll(ts, wallet):
+        now[0] = max(now[0], ts)
+        tracker.add_wallet(wallet)
+        stats["polls"] += 1
+        try:
+            stats["events"] += await tracker.poll_wallet(wallet, trader.process_trade)
+        except Exception:
+            stats["errors"] += 1
+        await trader.drain()
+    
+    try:
+        for record in iter_recording(directory, start, end):
+            stats["records"] += 1
+            http.load(record)
+            params = record.get("params") or {}
+            wallet = str(params.get("user", "")).lower()
+            if (urlsplit(record["url"]).path == "/positions" and not params.get("offset")
+                    and wallet and (not only or wallet in only)):
+                polls.append((record["t"], wallet))
+            while polls and polls[0][0] + lookahead <= record["t"]:
+                await poll(*polls.popleft())
+        while polls:
+            await poll(*polls.popleft())
+    finally:
+        for account in trader.accounts:
+            account.executor.shutdown()
+    
+    result = trader.summary()
+    result.update(stats, params=overrides, misses=http.misses, elapsed=time.perf_counter() - started)
+    return result
+
+def _backtest_job(directory: str, overrides: dict, start: float, end: float) -> dict:
+    return asyncio.run(run_backtest(directory, overrides, start, end))
+
+def sweep_backtests(directory: str, grid: dict, start: float = None, end: float = None, jobs: int = None) -> list:
+    """参数网格回测：{参数: [取值...]} 的每种组合一个子进程并行回放"""
+    keys = sorted(grid)
+    combos = [dict(zip(keys, values)) for values in product(*(grid[key] for key in keys))]
+    jobs = min(jobs or os.cpu_count() or 1, len(combos))
+    if jobs <= 1:
+        return [_backtest_job(directory, combo, start, end) for combo in combos]
+    n = len(combos)
+    with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(pool.map(_backtest_job, [directory] * n, combos, [start] * n, [end] * n))
+
+def print_backtest_results(results: list):
+    if not results:
+        return
+    first = results[0]
+    print(f"回放 {first['records']} 条记录, {first['polls']} 次轮询, {first['events']} 个事件, "
+          f"{first['errors']} 次缺数据 ({first['elapsed']:.1f} 秒/组)")
+    for r in sorted(results, key=lambda r: r["pnl"], reverse=True):
+        params = " ".join(f"{k}={v}" for k, v in r["params"].items()) or "(当前配置)"
+        print(f"{params:40s} 成交 {r['fills']:5d}  成交额 ${r['volume']:10.2f}  已实现 ${r['realized']:+9.2f}  "
+              f"未实现 ${r['unrealized']:+9.2f}  合计 ${r['pnl']:+9.2f}  敞口 ${r['exposure']:9.2f}")
+
+# ==================== 本地模拟服务器 ====================
+class MockPolymarket:
+    """本地模拟的 Data API + CLOB，联调和压测用，不需要真实接口和有资金的私钥
+    
+    wallets 个合成钱包各持有 positions 个仓位，后台按 trade_rate 笔/秒随机生成成交并同步
+    更新持仓。每个请求先等 latency 秒，再按 error_rate 返回 500、按 rate_limit_rate 返回 429
+    （带 Retry-After）。收到订单时记录从生成成交到收到订单的端到端延迟，/_mock/stats 查看。
+    
+    同一端口也接受 WebSocket 连接（STREAM_URL=ws://host:port），订阅后按 RTDS 格式推送
+    activity/trades 消息，每个连接的 seq 从 1 开始。stream_gap_rate 按比例丢弃消息（序号跳变，
+    这笔成交只能靠 REST 补齐），stream_drop_after 为每个连接推送这么多条后直接断开。
+    """
+    WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests",
+               500: "Internal Server Error"}
+    
+    def __init__(self, wallets: int = 10, positions: int = 100, trade_rate: float = 1.0, latency: float = 0.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, fill_ratio: float = 1.0, seed: int = 0,
+                 stream_gap_rate: float = 0.0, stream_drop_after: int = 0):
+        import random
+        self.rng = random.Random(seed)
+        self.trade_rate = trade_rate
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.fill_ratio = fill_ratio  # 订单立即成交的比例，小于 1 时剩余部分挂单
+        self.wallets = ["0x" + hashlib.sha1(f"mock-wallet-{w}".encode()).hexdigest() for w in range(wallets)]
+        self.positions = {}  # {wallet: {token: 持仓}}
+        self.prices = {}  # {token: 价格}
+        for w, wallet in enumerate(self.wallets):
+            book = self.positions[wallet] = {}
+            for i in range(positions):
+                token = f"{w + 1}{i:072d}"  # 十进制 token id 不能有前导零（客户端按整数处理）
+                self.prices[token] = round(self.rng.uniform(0.05, 0.95), 2)
+                book[token] = {"proxyWallet": wallet, "asset": token, "conditionId": f"0x{w:04x}{i:060x}",
+                               "size": round(self.rng.uniform(10, 5000), 2), "curPrice": self.prices[token],
+                               "title": f"Mock market {w}-{i}", "outcome": "Yes"}
+        self.trades = {wallet: deque(maxlen=5000) for wallet in self.wallets}  # 最新的在右
+        self.generated = {}  # {token: 最近一笔成交的生成时间}
+        self.orders = {}  # {order_id: 订单}
+        self.e2e = deque(maxlen=100_000)  # 成交生成 -> 收到订单（秒）
+        self.requests = {}  # {(方法, 路径): 次数}
+        self.trade_count = 0
+        self.stream_gap_rate = stream_gap_rate
+        self.stream_drop_after = stream_drop_after
+        self._subscribers = set()  # 每个实时流连接一个 asyncio.Queue
+        self.stream_stats = {"connections": 0, "messages": 0, "gaps": 0, "drops": 0}
+    
+    # ---------- 合成成交 ----------
+    def make_trade(self):
+        wallet = self.rng.choice(self.wallets)
+        book = self.positions[wallet]
+        pos = book[self.rng.choice(list(book))]
+        token = pos["asset"]
+        side = "BUY" if pos["size"] < 20 or self.rng.random() < 0.6 else "SELL"
+        size = round(min(self.rng.uniform(10, 200), pos["size"] if side == "SELL" else 1e9), 2)
+        mid = self.prices[token] = round(min(0.99, max(0.01, self.prices[token] + self.rng.choice((-0.01, 0, 0.01)))), 2)
+        # 目标是吃单方：买入成交在卖一，卖出成交在买一（与 /book 一致）
+        price = min(0.99, mid + 0.01) if side == "BUY" else max(0.01, mid - 0.01)
+        pos["size"] = round(pos["size"] + (size if side == "BUY" else -size), 2)
+        pos["curPrice"] = mid
+        self.trade_count += 1
+        trade = {
+            "proxyWallet": wallet, "side": side, "asset": token, "conditionId": pos["conditionId"],
+            "size": size, "price": price, "timestamp": int(time.time()),
+            "transactionHash": f"0x{self.trade_count:064x}", "title": pos["title"], "outcome": "Yes"
+        }
+        self.trades[wallet].append(trade)
+        self.generated[token] = time.perf_counter()
+        for subscriber in self._subscribers:
+            subscriber.put_nowait(trade)
+    
+    async def _generate(self):
+        if self.trade_rate <= 0:
+            return
+        interval = 1 / self.trade_rate
+        next_at = time.perf_counter()
+        while True:
+            # 按时间补齐，事件循环偶尔卡顿时整体速率仍然准确
+            while next_at <= time.perf_counter():
+                self.make_trade()
+                next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+    
+    # ---------- 路由 ----------
+    @staticmethod
+    def _page(items: list, params: dict) -> list:
+        offset = int(params.get("offset", 0))
+        return items[offset:offset + int(params.get("limit", 100))]
+    
+    def route(self, method: str, path: str, params: dict, body):
+        """返回 (状态码, JSON 对象)"""
+        if path == "/positions":
+            book = self.positions.get(str(params.get("user", "")).lower(), {})
+            threshold = float(params.get("sizeThreshold", 0))
+            items = sorted((p for p in book.values() if p["size"] >= threshold), key=lambda p: -p["size"])
+            return 200, self._page(items, params)
+        if path == "/trades":
+            trades = self.trades.get(str(params.get("user", "")).lower(), ())
+            return 200, self._page(list(reversed(trades)), params)
+        if path.startswith("/markets/"):
+            market = path.rsplit("/", 1)[1]
+            return 200, {"condition_id": market, "question": f"Mock market {market[:12]}", "closed": False,
+                         "minimum_tick_size": 0.01}
+        if path == "/book":
+            price = self.prices.get(params.get("token_id"))
+            if price is None:
+                return 404, {"error": "No orderbook exists for the requested token id"}
+            bid, ask = max(0.01, price - 0.01), min(0.99, price + 0.01)
+            return 200, {"asset_id": params.get("token_id"),
+                         "bids": [{"price": f"{bid - i * 0.01:.2f}", "size": "500"} for i in range(5) if bid - i * 0.01 > 0],
+                         "asks": [{"price": f"{ask + i * 0.01:.2f}", "size": "500"} for i in range(5) if ask + i * 0.01 < 1]}
+        if path == "/tick-size":
+            return 200, {"minimum_tick_size": 0.01}
+        if path == "/neg-risk":
+            return 200, {"neg_risk": False}
+        if path == "/fee-rate":
+            return 200, {"base_fee": 0}
+        if path == "/order" and method == "POST":
+            return self._post_order(body or {})
+        if path == "/data/orders":
+            live = [order for order in self.orders.values() if order["status"] == "LIVE"]
+            return 200, {"data": live, "next_cursor": "LTE="}
+        if path.startswith("/data/order/"):
+            return 200, self.orders.get(path.rsplit("/", 1)[1]) or {}
+        if path == "/orders" and method == "DELETE":
+            canceled = []
+            for order_id in body or ():
+                if self.orders.get(order_id, {}).get("status") == "LIVE":
+                    self.orders[order_id]["status"] = "CANCELED"
+                    canceled.append(order_id)
+            return 200, {"canceled": canceled, "not_canceled": {}}
+        if path == "/_mock/stats":
+            return 200, self.stats()
+        return 404, {"error": "not found"}
+    
+    def _post_order(self, body: dict):
+        order = body.get("order") or {}
+        token = order.get("tokenId")
+        generated = self.generated.get(token)
+        if generated is not None:
+            self.e2e.append(time.perf_counter() - generated)
+        buy = order.get("side") == "BUY"
+        size = int(order.get("takerAmount" if buy else "makerAmount") or 0) / 1e6
+        order_id = f"0x{hashlib.sha1(f'{len(self.orders)}:{token}'.encode()).hexdigest()}"
+        matched = round(size * self.fill_ratio, 2)
+        self.orders[order_id] = {"id": order_id, "status": "MATCHED" if matched >= size else "LIVE",
+                                 "asset_id": token, "side": order.get("side"), "original_size": str(size),
+                                 "size_matched": str(matched), "price": str(self.prices.get(token, 0))}
+        return 200, {"success": True, "errorMsg": "", "orderID": order_id,
+                     "status": "matched" if matched >= size else "live"}
+    
+    def stats(self) -> dict:
+        e2e = sorted(self.e2e)
+        pick = lambda q: e2e[min(len(e2e) - 1, int(len(e2e) * q))] if e2e else 0.0
+        return {"trades": self.trade_count, "orders": len(self.orders),
+                "e2e": {"count": len(e2e), "p50": pick(0.5), "p99": pick(0.99)}, "stream": self.stream_stats,
+                "requests": {f"{method} {path}": n for (method, path), n in sorted(self.requests.items())}}
+    
+    # ---------- HTTP ----------
+    async def _handle(self, reader, writer):
+        """HTTP/1.1 keep-alive：一个连接上依次处理多个请求"""
+        try:
+            while True:
+                request = await reader.readline()
+                if not request.strip():
+                    break
+                request_headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    request_headers[name.strip().lower()] = value.strip()
+                length = int(request_headers.get("content-length", 0))
+                raw = await reader.readexactly(length) if length else b""
+                method, target = request.decode("latin-1").split(" ")[:2]
+                url = httpx.URL(target)
+                path = url.path
+                if request_headers.get("upgrade", "").lower() == "websocket":
+                    self.requests[("WS", path)] = self.requests.get(("WS", path), 0) + 1
+                    await self._stream(reader, writer, request_headers.get("sec-websocket-key", ""))
+                    break
+                counted = "/data/order/" if path.startswith("/data/order/") else (
+                    "/markets/" if path.startswith("/markets/") else path)
+                self.requests[(method, counted)] = self.requests.get((method, counted), 0) + 1
+                
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                headers = ""
+                if path.startswith("/_mock/"):
+                    code, payload = self.route(method, path, {}, None)
+                elif self.rng.random() < self.rate_limit_rate:
+                    code, payload, headers = 429, {"error": "rate limited"}, "Retry-After: 1\r\n"
+                elif self.rng.random() < self.error_rate:
+                    code, payload = 500, {"error": "injected error"}
+                else:
+                    code, payload = self.route(method, path, dict(url.params), json.loads(raw) if raw else None)
+                data = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {code} {self.REASONS.get(code, 'OK')}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n{headers}\r\n".encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.debug(f"模拟服务器请求处理失败: {e}")
+        finally:
+            writer.close()
+    
+    # ---------- 实时流（WebSocket） ----------
+    @staticmethod
+    def _ws_frame(opcode: int, data: bytes) -> bytes:
+        """服务端帧不加掩码"""
+        n = len(data)
+        if n < 126:
+            header = bytes((0x80 | opcode, n))
+        elif n < 65536:
+            header = bytes((0x80 | opcode, 126)) + n.to_bytes(2, "big")
+        else:
+            header = bytes((0x80 | opcode, 127)) + n.to_bytes(8, "big")
+        return header + data
+    
+    async def _ws_read(self, reader, writer, subscribed: asyncio.Event):
+        """读取客户端帧：文本帧视为订阅，回应 ping，收到 close 后结束"""
+        while True:
+            head = await reader.readexactly(2)
+            opcode, n = head[0] & 0x0F, head[1] & 0x7F
+            if n == 126:
+                n = int.from_bytes(await reader.readexactly(2), "big")
+            elif n == 127:
+                n = int.from_bytes(await reader.readexactly(8), "big")
+            mask = await reader.readexactly(4) if head[1] & 0x80 else b"\0\0\0\0"
+            data = bytes(b ^ mask[i % 4] for i, b in enumerate(await reader.readexactly(n)))
+            if opcode == 0x1:
+                subscribed.set()
+            elif opcode == 0x9:
+                writer.write(self._ws_frame(0xA, data))
+            elif opcode == 0x8:
+                writer.write(self._ws_frame(0x8, data[:2]))
+                return
+    
+    async def _stream(self, reader, writer, key: str):
+        accept = base64.b64encode(hashlib.sha1((key + self.WS_GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        await writer.drain()
+        self.stream_stats["connections"] += 1
+        subscribed = asyncio.Event()
+        read_task = asyncio.create_task(self._ws_read(reader, writer, subscribed))
+        trades = asyncio.Queue()
+        seq = sent = 0
+        waiter = asyncio.create_task(subscribed.wait())
+        try:
+            await asyncio.wait([read_task, waiter], return_when=asyncio.FIRST_COMPLETED)
+            self._subscribers.add(trades)
+            while not read_task.done():
+                # 客户端断开时不必等到下一笔成交
+                waiter = asyncio.create_task(trades.get())
+                await asyncio.wait([read_task, waiter], return_when=asyncio.FIRST_COMPLETED)
+                if not waiter.done():
+                    break
+                trade = waiter.result()
+                seq += 1
+                if self.rng.random() < self.stream_gap_rate:
+                    self.stream_stats["gaps"] += 1
+                    continue  # 丢掉这条，下一条的 seq 出现跳变
+                message = {"topic": "activity", "type": "trades", "seq": seq, "timestamp": int(time.time() * 1000),
+                           "payload": trade}
+                writer.write(self._ws_frame(0x1, json.dumps(message).encode()))
+                await writer.drain()
+                self.stream_stats["messages"] += 1
+                sent += 1
+                if self.stream_drop_after and sent >= self.stream_drop_after:
+                    self.stream_stats["drops"] += 1
+                    break  # 不发 close 帧直接断开，模拟网络中断
+        finally:
+            self._subscribers.discard(trades)
+            waiter.cancel()
+            read_task.cancel()
+    
+    async def serve(self, port: int = 0, host: str = "127.0.0.1"):
+        """启动 HTTP 服务和成交生成，返回 (server, 实际端口)"""
+        server = await asyncio.start_server(self._handle, host, port)
+        self._generator = asyncio.create_task(self._generate())
+        return server, server.sockets[0].getsockname()[1]
+
+def run_mock_server(port: int, ready=None, **options):
+    """在当前进程运行模拟服务器直到被终止；ready 为队列时放入实际端口"""
+    async def main():
+        mock = MockPolymarket(**options)
+        server, actual = await mock.serve(port)
+        if ready is not None:
+            ready.put((actual, mock.wallets))
+        else:
+            print(f"🧪 模拟服务器 http://127.0.0.1:{actual}  ({len(mock.wallets)} 个钱包, {mock.trade_rate:g} 笔/秒)")
+            print(f"   DATA_API_URL=http://127.0.0.1:{actual}")
+            print(f"   CLOB_HOST=http://127.0.0.1:{actual}")
+            print(f"   STREAM_URL=ws://127.0.0.1:{actual}  (INGEST_MODE=stream)")
+            print(f"   TARGET_WALLETS={','.join(mock.wallets)}")
+        async with server:
+            await server.serve_forever()
+    
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+def _bench_load_job(url: str, wallets: list, duration: float, poll_interval: float, live: bool) -> dict:
+    """压测子进程：按给定配置运行一遍机器人，返回本进程的延迟、CPU 和内存"""
+    import resource
+    os.environ.update(DATA_API_URL=url, CLOB_HOST=url, STATE_DB="", METRICS_PORT="0", RECORD_DIR="", ACCOUNTS="",
+                      PAPER_MODE="false" if live else "true", POLL_INTERVAL=str(poll_interval),
+                      MIN_POLL_INTERVAL=str(poll_interval), MAX_POLL_INTERVAL=str(poll_interval))
+    os.environ.setdefault("DATA_API_RPS", "1000")
+    logger.setLevel(logging.WARNING)
+    client = None
+    if live:
+        # 一次性随机私钥和凭证，只发给本地模拟服务器
+        os.environ.update(API_KEY="bench", API_SECRET=base64.urlsafe_b64encode(os.urandom(32)).decode(),
+                          API_PASSPHRASE="bench")
+        client = create_clob_client("0x" + os.urandom(32).hex())
+    
+    async def main():
+        trader = RESTCopyTrader(client, wallets)
+        started = time.perf_counter()
+        cpu = time.process_time()
+        task = asyncio.create_task(trader.run())
+        await asyncio.sleep(duration)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        polls = sum(state["polls"] for state in trader.scheduler.wallets.values())
+        summary = metrics.summary()
+        return {
+            "stages": summary["stages"],
+            "counters": summary["counters"],
+            "polls": polls,
+            "cycle": elapsed * len(wallets) / polls if polls else 0.0,  # 每个钱包实际轮询周期
+            "cpu": (time.process_time() - cpu) / elapsed,
+            "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        }
+    
+    return asyncio.run(main())
+
+def bench_load(wallet_counts: list, rates: list, positions: int = 100, duration: float = 30,
+               poll_interval: float = 2, latency: float = 0.0, error_rate: float = 0.0,
+               rate_limit_rate: float = 0.0, live: bool = True):
+    """端到端压测：本地模拟服务器 + 完整机器人，按钱包数 x 成交速率逐组运行
+    
+    模拟服务器和机器人各在独立的 spawn 子进程中运行，CPU 和 RSS 只统计机器人进程。
+    报告检测->提交延迟（机器人内部）、成交生成->收到订单（端到端，live 模式）、拉取耗时、
+    每个钱包的实际轮询周期、CPU 和峰值 RSS。
+    """
+    if live and importlib.util.find_spec("py_clob_client") is None:
+        print("⚠️ 未安装 py_clob_client，改用模拟模式（不签名、不提交订单）")
+        live = False
+    ctx = multiprocessing.get_context("spawn")
+    ms = lambda stage: (stage["p50"] * 1000, stage["p99"] * 1000) if stage else (0.0, 0.0)
+    print(f"压测: 每个钱包 {positions} 个持仓, 每组 {duration:g} 秒, 轮询间隔 {poll_interval:g} 秒, "
+          f"延迟 {latency * 1000:g} ms, 错误率 {error_rate:.0%}, 429 比例 {rate_limit_rate:.0%}, "
+          f"{'签名并提交订单' if live else '模拟模式'}")
+    print(f"{'钱包':>6} {'笔/秒':>6} {'事件':>6} {'订单':>6} {'检测->提交 p50/p99 ms':>22} {'端到端 p50/p99 ms':>20} "
+          f"{'拉取 p50/p99 ms':>18} {'周期 s':>7} {'CPU':>6} {'RSS MB':>7} {'错误':>5}")
+    for wallet_count, rate in product(wallet_counts, rates):
+        ready = ctx.Queue()
+        server = ctx.Process(target=run_mock_server, daemon=True, args=(0, ready), kwargs=dict(
+            wallets=wallet_count, positions=positions, trade_rate=rate, latency=latency,
+            error_rate=error_rate, rate_limit_rate=rate_limit_rate))
+        server.start()
+        try:
+            port, wallets = ready.get(timeout=60)
+            url = f"http://127.0.0.1:{port}"
+            with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                result = pool.submit(_bench_load_job, url, wallets, duration, poll_interval, live).result()
+            mock = httpx.get(f"{url}/_mock/stats", timeout=10).json()
+        finally:
+            server.terminate()
+            server.join()
+        counters = result["counters"]
+        count = lambda prefix: sum(v for k, v in counters.items() if k.startswith(prefix))
+        stages = result["stages"]
+        orders = count('orders{status="accepted"') + count('orders{status="simulated"')
+        # Data API 的 HTTP 错误已计入 errors{stage="fetch"}，只另加 CLOB 请求的 HTTP 错误
+        errors = count("errors") + sum(v for k, v in counters.items() if k.startswith("http_errors")
+                                       and 'path="/positions"' not in k and 'path="/trades"' not in k)
+        print(f"{wallet_count:>6} {rate:>6g} {count('events'):>6.0f} {orders:>6.0f} "
+              f"{'%9.1f / %9.1f' % ms(stages.get('detect_to_order')):>22} "
+              f"{'%8.1f / %8.1f' % ms(mock['e2e']) if mock['e2e']['count'] else '-':>20} "
+              f"{'%7.1f / %7.1f' % ms(stages.get('fetch')):>18} {result['cycle']:>7.2f} "
+              f"{result['cpu']:>6.0%} {result['rss_mb']:>7.0f} {errors:>5.0f}")
+
+# ==================== CLOB 客户端 ====================
+def create_clob_client(private_key: str, prefix: str = ""):
+    """创建 ClobClient 并加载 API 凭证（.env 中没有时生成并保存；跟随账户的键带 prefix）"""
+    from py_clob_client.client import ClobClient
+    from py_clob_client.clob_types import ApiCreds
+    
+    client = ClobClient(
+        host=os.getenv("CLOB_HOST", CLOB_HOST).rstrip("/"),
+        key=private_key,
+        chain_id=CHAIN_ID
+    )
+    
+    # 确保有API creds
+    api_key = os.getenv(prefix + "API_KEY")
+    api_secret = os.getenv(prefix + "API_SECRET")
+    api_passphrase = os.getenv(prefix + "API_PASSPHRASE")
+    
+    if not all([api_key, api_secret, api_passphrase]):
+        logger.info(f"未找到{prefix}API凭证，正在生成...")
+        creds = client.create_or_derive_api_creds()
+        set_key(ENV_FILE, prefix + "API_KEY", creds.api_key)
+        set_key(ENV_FILE, prefix + "API_SECRET", creds.api_secret)
+        set_key(ENV_FILE, prefix + "API_PASSPHRASE", creds.api_passphrase)
+        client.set_api_creds(creds)
+        logger.info(f"✅ {prefix}API凭证已生成并保存")
+    else:
+        # 加载已有 creds
+        client.set_api_creds(ApiCreds(api_key=api_key, api_secret=api_secret, api_passphrase=api_passphrase))
+        logger.info(f"✅ 使用已有{prefix}API凭证")
+    return client
+
+def follower_clients(lazy_http: AsyncHTTPClient = None) -> dict:
+    """为实盘的跟随账户创建客户端 {名称: client}；lazy_http 不为空时返回 LazyClobClient
+    
+    缺少 <名称>_PRIVATE_KEY 时抛出 ValueError。
+    """
+    clients = {}
+    for name, prefix in follower_accounts():
+        if account_paper_mode(prefix):
+            continue
+        private_key = os.getenv(prefix + "PRIVATE_KEY", "")
+        if not private_key:
+            raise ValueError(f"账户 {name} 实盘需要配置 {prefix}PRIVATE_KEY")
+        if lazy_http is not None:
+            clients[name] = LazyClobClient(private_key, lazy_http, prefix)
+        else:
+            clients[name] = create_clob_client(private_key, prefix)
+    return clients
+
+class LazyClobClient:
+    """第一次使用时才导入 py_clob_client 并创建客户端，启动不等这 1 秒
+    
+    headless 模式启动后在线程池里调用 get() 预热，通常在第一笔订单之前就已就绪。
+    """
+    
+    def __init__(self, private_key: str, http: AsyncHTTPClient = None, prefix: str = ""):
+        self._private_key = private_key
+        self._http = http
+        self._prefix = prefix
+        self._client = None
+        self._lock = threading.Lock()
+    
+    def get(self):
+        with self._lock:
+            if self._client is None:
+                if self._http is not None:
+                    self._http.install_clob_transport()
+                self._client = create_clob_client(self._private_key, self._prefix)
+        return self._client
+    
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
 
 # ==================== 主程序 ====================
 def main():
@@ -501,40 +3991,16 @@ def main():
             try:
                 print("初始化 CLOB 客户端...")
                 
-                # 创建 client
-                client = ClobClient(
-                    host=CLOB_HOST,
-                    key=private_key,
-                    chain_id=CHAIN_ID
-                )
-                
-                # 确保有API creds
-                api_key = os.getenv("API_KEY")
-                api_secret = os.getenv("API_SECRET")
-                api_passphrase = os.getenv("API_PASSPHRASE")
+                # Data API 与 CLOB 共用一个连接池
+                http = AsyncHTTPClient.from_env()
+                http.install_clob_transport()
                 
-                if not all([api_key, api_secret, api_passphrase]):
-                    print("未找到API凭证，正在生成...")
-                    creds = client.create_or_derive_api_creds()
-                    api_key = creds.api_key
-                    api_secret = creds.api_secret
-                    api_passphrase = creds.api_passphrase
-                    set_key(ENV_FILE, "API_KEY", api_key)
-                    set_key(ENV_FILE, "API_SECRET", api_secret)
-                    set_key(ENV_FILE, "API_PASSPHRASE", api_passphrase)
-                    print("✅ API凭证已生成并保存")
-                else:
-                    # 加载已有 creds
-                    client.set_api_creds(
-                        api_key=api_key,
-                        api_secret=api_secret,
-                        api_passphrase=api_passphrase
-                    )
-                    print("✅ 使用已有API凭证")
+                client = create_clob_client(private_key)
+                clients = follower_clients()
                 
                 targets = [addr.strip() for addr in target_wallets.split(",")]
                 
-                rest_trader = RESTCopyTrader(client, targets)
+                rest_trader = RESTCopyTrader(client, targets, http=http, clients=clients)
                 asyncio.run(rest_trader.run())
                 
             except KeyboardInterrupt:
@@ -555,14 +4021,15 @@ def main():
             print(f"模拟模式: {os.getenv('PAPER_MODE', 'true')}")
             print(f"轮询间隔: {os.getenv('POLL_INTERVAL', '30')}秒")
             
-            # 检查日志文件
-            if os.path.exists("bot.log"):
+            # 检查日志文件（只从末尾读最后几行）
+            if os.path.exists(LOG_FILE):
                 print("\n最近日志:")
                 try:
-                    with open("bot.log", "r") as f:
-                        lines = f.readlines()[-5:]
-                        for line in lines:
-                            print(line.strip())
+                    for line in tail_lines(LOG_FILE, 5):
+                        if line.startswith("{"):
+                            entry = json.loads(line)
+                            line = f"{datetime.fromtimestamp(entry['ts']):%Y-%m-%d %H:%M:%S} | {entry['level']:5s} | {entry['msg']}"
+                        print(line.strip())
                 except:
                     print("无法读取日志")
         
@@ -573,7 +4040,138 @@ def main():
         else:
             print("❌ 无效选项")
 
+def run_headless() -> int:
+    """非交互启动（python bot.py run）：不检查依赖、不进菜单，供 supervisor / systemd 使用
+    
+    模拟模式不导入 py_clob_client；实盘时客户端在后台线程创建，不推迟第一轮轮询。
+    SIGTERM / SIGINT 时停止轮询，执行完已入队的订单并把状态落盘后退出；SIGHUP 重新加载 .env。
+    """
+    load_dotenv(ENV_FILE)
+    targets = [addr.strip() for addr in os.getenv("TARGET_WALLETS", "").split(",") if addr.strip()]
+    if not targets:
+        logger.error("❌ 请先配置跟单地址 TARGET_WALLETS")
+        return 2
+    paper_mode = os.getenv("PAPER_MODE", "true").lower() == "true"
+    private_key = os.getenv("PRIVATE_KEY", "")
+    if not paper_mode and not private_key:
+        logger.error("❌ 实盘模式需要配置私钥 PRIVATE_KEY")
+        return 2
+    for name, prefix in follower_accounts():
+        if not account_paper_mode(prefix) and not os.getenv(prefix + "PRIVATE_KEY"):
+            logger.error(f"❌ 账户 {name} 实盘需要配置 {prefix}PRIVATE_KEY")
+            return 2
+    return asyncio.run(_run_headless(targets, None if paper_mode else private_key))
+
+async def _run_headless(targets: list, private_key: str = None) -> int:
+    http = AsyncHTTPClient.from_env()
+    client = LazyClobClient(private_key, http) if private_key else None
+    clients = follower_clients(lazy_http=http)
+    trader = RESTCopyTrader(client, targets, http=http, clients=clients)
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(trader.run())
+    exit_code = 0
+    
+    def stop(reason: str, code: int = 0):
+        nonlocal exit_code
+        exit_code = exit_code or code
+        logger.info("🛑 %s，停止轮询，执行完已入队订单并保存状态...", reason)
+        task.cancel()
+    
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop, f"收到 {sig.name}")
+    # kill -HUP 立即重新读取 .env（不等定时检查）
+    loop.add_signal_handler(signal.SIGHUP, trader.reload_config)
+    
+    def client_ready(future):
+        if future.exception() is not None:
+            logger.error(f"❌ 创建 CLOB 客户端失败: {future.exception()}")
+            stop("无法下单", 1)
+    for lazy in [client] + list(clients.values()):
+        if lazy is not None:
+            loop.run_in_executor(None, lazy.get).add_done_callback(client_ready)
+    
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return exit_code
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Polymarket 跟单机器人（不带参数进入交互菜单）")
+    parser.add_argument("--stats", action="store_true", help="打印运行中机器人的耗时统计和计数（METRICS_PORT）")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("run", help="非交互启动（读取 .env，不检查依赖，SIGTERM 时保存状态退出）")
+    bench = sub.add_parser("bench", help="性能基准")
+    bench.add_argument("target", choices=["dedup", "diff", "load"], help="基准项目（load 为本地模拟服务器端到端压测）")
+    bench.add_argument("--n", type=int, default=10_000_000, help="写入条数（dedup）")
+    bench.add_argument("--max-items", type=int, default=100_000, help="去重容量")
+    bench.add_argument("--bloom-bits", type=int, default=0, help="布隆过滤器位数（0 为关闭）")
+    bench.add_argument("--bloom-fp", type=float, default=0.001, help="布隆过滤器目标误判率")
+    bench.add_argument("--wallets", type=int, default=50, help="钱包数（diff）")
+    bench.add_argument("--positions", type=int, default=500, help="每个钱包的持仓数（diff）")
+    bench.add_argument("--cycles", type=int, default=20, help="轮数（diff）")
+    bench.add_argument("--wallet-counts", default="10,50,200", help="逐组压测的钱包数，逗号分隔（load）")
+    bench.add_argument("--rates", default="1,10", help="逐组压测的成交速率（笔/秒），逗号分隔（load）")
+    bench.add_argument("--load-positions", type=int, default=100, help="模拟服务器每个钱包的持仓数（load）")
+    bench.add_argument("--duration", type=float, default=30, help="每组运行秒数（load）")
+    bench.add_argument("--poll-interval", type=float, default=2, help="轮询间隔秒数（load）")
+    bench.add_argument("--latency-ms", type=float, default=0, help="模拟服务器每个请求的延迟（load）")
+    bench.add_argument("--error-rate", type=float, default=0, help="模拟服务器返回 500 的比例（load）")
+    bench.add_argument("--rate-limit-rate", type=float, default=0, help="模拟服务器返回 429 的比例（load）")
+    bench.add_argument("--paper", action="store_true", help="模拟模式，不签名不提交订单（load）")
+    mock = sub.add_parser("mock", help="启动本地模拟 Data API + CLOB 服务器")
+    mock.add_argument("--port", type=int, default=8080)
+    mock.add_argument("--wallets", type=int, default=10, help="合成钱包数")
+    mock.add_argument("--positions", type=int, default=100, help="每个钱包的持仓数")
+    mock.add_argument("--rate", type=float, default=1, help="合成成交速率（笔/秒）")
+    mock.add_argument("--latency-ms", type=float, default=0, help="每个请求的延迟")
+    mock.add_argument("--error-rate", type=float, default=0, help="返回 500 的比例")
+    mock.add_argument("--rate-limit-rate", type=float, default=0, help="返回 429 的比例")
+    mock.add_argument("--fill-ratio", type=float, default=1, help="订单立即成交的比例，其余挂单")
+    mock.add_argument("--stream-gap-rate", type=float, default=0, help="实时流丢弃消息（序号跳变）的比例")
+    mock.add_argument("--stream-drop-after", type=int, default=0, help="实时流每个连接推送多少条后断开（0 为不断开）")
+    backtest = sub.add_parser("backtest", help="回放 RECORD_DIR 录制的数据做回测")
+    backtest.add_argument("directory", help="录制目录")
+    backtest.add_argument("--start", type=parse_time, help="开始时间（时间戳或 ISO，UTC）")
+    backtest.add_argument("--end", type=parse_time, help="结束时间")
+    backtest.add_argument("--set", action="append", default=[], metavar="KEY=V1,V2",
+                          help="覆盖参数，多个取值时做网格扫描（可重复）")
+    backtest.add_argument("--jobs", type=int, default=0, help="并行进程数（默认 CPU 核数）")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.stats:
+        load_dotenv(ENV_FILE)
+        print_stats()
+        sys.exit(0)
+    if args.command == "run":
+        sys.exit(run_headless())
+    if args.command == "bench":
+        if args.target == "dedup":
+            bench_dedup(args.n, args.max_items, args.bloom_bits, args.bloom_fp)
+        elif args.target == "diff":
+            bench_position_diff(args.wallets, args.positions, args.cycles)
+        else:
+            load_dotenv(ENV_FILE)
+            bench_load([int(n) for n in args.wallet_counts.split(",")], [float(r) for r in args.rates.split(",")],
+                       args.load_positions, args.duration, args.poll_interval, args.latency_ms / 1000,
+                       args.error_rate, args.rate_limit_rate, live=not args.paper)
+        sys.exit(0)
+    if args.command == "mock":
+        run_mock_server(args.port, wallets=args.wallets, positions=args.positions, trade_rate=args.rate,
+                        latency=args.latency_ms / 1000, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, fill_ratio=args.fill_ratio,
+                        stream_gap_rate=args.stream_gap_rate, stream_drop_after=args.stream_drop_after)
+        sys.exit(0)
+    if args.command == "backtest":
+        load_dotenv(ENV_FILE)
+        grid = {}
+        for item in args.set:
+            key, _, values = item.partition("=")
+            grid[key.strip()] = values.split(",")
+        print_backtest_results(sweep_backtests(args.directory, grid, args.start, args.end, args.jobs or None))
+        sys.exit(0)
     try:
         main()
     except KeyboardInterrupt:
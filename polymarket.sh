@@ -12,6 +12,13 @@ VENV_DIR="$BOT_DIR/venv"
 PYTHON_CMD="$VENV_DIR/bin/python3"
 PIP_CMD="$VENV_DIR/bin/pip"
 SCREEN_NAME="polymarket-v2"
+# ./polymarket.sh 进入交互菜单；./polymarket.sh run 无人值守运行（需已配置 .env，可配合 supervisor/systemd）
+MODE="${1:-menu}"
+if [ "$MODE" = "run" ]; then
+    BOT_CMD="python3 bot.py run"
+else
+    BOT_CMD="python3 bot.py"
+fi
 
 echo "===== Polymarket 跟单机器人 V2.0 一键部署 ====="
 echo "自动创建 venv + 安装依赖 + 启动 screen"
@@ -38,10 +45,10 @@ fi
 echo "激活 venv 并安装核心依赖..."
 source "$VENV_DIR/bin/activate"
 "$PIP_CMD" install --upgrade pip -q
-"$PIP_CMD" install py-clob-client requests python-dotenv -q
+"$PIP_CMD" install py-clob-client httpx python-dotenv websockets numpy -q
 
 echo "依赖安装完成："
-"$PIP_CMD" list | grep -E 'py-clob-client|requests|python-dotenv'
+"$PIP_CMD" list | grep -E 'py-clob-client|httpx|python-dotenv|websockets|numpy'
 
 # 5. 下载/更新 bot.py
 echo "下载/更新 bot.py..."
@@ -72,7 +79,7 @@ fi
 
 # 8. 启动 screen（用 venv 的 python）
 echo "启动 screen 会话 $SCREEN_NAME..."
-screen -dmS "$SCREEN_NAME" bash -c "cd '$BOT_DIR' && source '$VENV_DIR/bin/activate' && exec python3 bot.py"
+screen -dmS "$SCREEN_NAME" bash -c "cd '$BOT_DIR' && source '$VENV_DIR/bin/activate' && exec $BOT_CMD"
 
 # 等待2秒确保screen启动
 sleep 2
@@ -80,6 +87,10 @@ sleep 2
 # 9. 检查screen是否运行
 if screen -list | grep -q "$SCREEN_NAME"; then
     echo "✅ Screen会话 $SCREEN_NAME 已启动"
+    if [ "$MODE" = "run" ]; then
+        echo "无人值守模式，查看: screen -r $SCREEN_NAME"
+        exit 0
+    fi
     echo "正在进入screen..."
     sleep 1
     screen -r "$SCREEN_NAME"
@@ -87,7 +98,7 @@ else
     echo "❌ Screen启动失败，直接在前台运行..."
     cd "$BOT_DIR"
     source "$VENV_DIR/bin/activate"
-    python3 bot.py
+    $BOT_CMD
 fi
 
 exit 0
@@ -0,0 +1,148 @@
+"""OrderManager 对账：实盘账户对着 MockPolymarket（fill_ratio < 1，下单只成交一部分）"""
+import asyncio
+import base64
+import contextlib
+import os
+
+import pytest
+
+import bot
+
+FILL_RATIO = 0.4
+
+
+@pytest.fixture(autouse=True)
+def live_env(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    for key, value in dict(STATE_DB="", METRICS_PORT="0", RECORD_DIR="", ACCOUNTS="", PAPER_MODE="false",
+                           TRADE_MULTIPLIER="1", MIN_TRADE_USD="1", MAX_TRADE_USD="1000",
+                           MAX_WALLET_EXPOSURE_USD="0", MAX_TOTAL_EXPOSURE_USD="0", ORDER_TIMEOUT="60",
+                           ORDER_MAX_REPRICES="0", API_KEY="test", API_PASSPHRASE="test",
+                           API_SECRET=base64.urlsafe_b64encode(os.urandom(32)).decode()).items():
+        monkeypatch.setenv(key, value)
+
+
+@contextlib.asynccontextmanager
+async def live_account():
+    """启动模拟服务器（不自动生成成交），返回 (mock, 主账户)"""
+    mock = bot.MockPolymarket(wallets=1, positions=5, trade_rate=0, fill_ratio=FILL_RATIO)
+    server, port = await mock.serve(0)
+    url = f"http://127.0.0.1:{port}"
+    os.environ.update(DATA_API_URL=url, CLOB_HOST=url)
+    client = await asyncio.to_thread(bot.create_clob_client, "0x" + os.urandom(32).hex())
+    trader = bot.RESTCopyTrader(client, mock.wallets)
+    try:
+        yield mock, trader.account
+    finally:
+        trader.account.executor.shutdown()
+        await trader.http.aclose()
+        server.close()
+
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+def copy_buy(mock, account, size: float = 100):
+    """按卖一价跟一笔目标买入，返回 (钱包, token, 下单价)"""
+    wallet = mock.wallets[0]
+    token = next(iter(mock.positions[wallet]))
+    price = round(mock.prices[token] + 0.01, 2)
+    account.copy(wallet, {"market": token, "price": price, "size": size, "side": "buy", "timestamp": 0}, "mock")
+    return wallet, token, price
+
+
+def only_order(account) -> dict:
+    assert len(account.orders) == 1
+    return next(iter(account.orders.orders.values()))
+
+
+def test_partial_fill_is_reconciled_and_stays_tracked():
+    async def scenario():
+        async with live_account() as (mock, account):
+            wallet, token, price = copy_buy(mock, account)
+            await wait_for(lambda: len(account.orders) == 1)
+            await account.orders.poll()
+            order = only_order(account)
+            assert order["matched"] == pytest.approx(100 * FILL_RATIO)
+            assert not order["cancelled"]
+            assert account.ledger.shares(wallet, token) == pytest.approx(100)  # 还在挂单，额度不释放
+    asyncio.run(scenario())
+
+
+def test_timeout_cancels_and_releases_unfilled():
+    async def scenario():
+        async with live_account() as (mock, account):
+            account.orders.timeout = 0.01
+            wallet, token, price = copy_buy(mock, account)
+            await wait_for(lambda: len(account.orders) == 1)
+            order_id = only_order(account)["id"]
+            await asyncio.sleep(0.02)
+            await account.orders.poll()  # 超时撤单
+            assert mock.orders[order_id]["status"] == "CANCELED"
+            assert account.orders.orders[order_id]["cancelled"]
+            await account.orders.poll()  # 确认最终成交量，未成交部分撤回账本
+            assert len(account.orders) == 0
+            entry = account.ledger.entries[(wallet, token)]
+            assert entry[0] == pytest.approx(40)
+            assert entry[1] == pytest.approx(40 * price)
+    asyncio.run(scenario())
+
+
+def test_reprice_then_release():
+    async def scenario():
+        async with live_account() as (mock, account):
+            account.order_max_reprices = 1
+            account.orders.timeout = 0.01
+            wallet, token, price = copy_buy(mock, account)
+            await wait_for(lambda: len(account.orders) == 1)
+            first = only_order(account)["id"]
+            await asyncio.sleep(0.02)
+            await account.orders.poll()
+            await account.orders.poll()  # 剩余 60 按新盘口重挂
+            await wait_for(lambda: len(account.orders) == 1)
+            repriced = only_order(account)
+            assert repriced["id"] != first
+            assert repriced["reprices"] == 1
+            assert repriced["size"] == pytest.approx(60)
+            await asyncio.sleep(0.02)
+            await account.orders.poll()
+            await account.orders.poll()  # 重挂次数用完，剩余 36 撤回
+            assert len(account.orders) == 0
+            assert account.ledger.shares(wallet, token) == pytest.approx(40 + 24)
+    asyncio.run(scenario())
+
+
+def test_order_placed_during_poll_is_not_closed():
+    async def scenario():
+        async with live_account() as (mock, account):
+            loop = asyncio.get_running_loop()
+            copy_buy(mock, account)
+            await wait_for(lambda: len(account.orders) == 1)
+            first = only_order(account)["id"]
+            get_orders = account.client.get_orders
+
+            def get_orders_then_place():
+                # 挂单列表已经取回后再下一单：新订单不在这次的列表里
+                open_orders = get_orders()
+                asyncio.run_coroutine_threadsafe(
+                    account.execute_copy_trade(first_token, "buy", ask, 50, "mock", wallet=mock.wallets[0]),
+                    loop).result(timeout=5)
+                return open_orders
+
+            first_token = account.orders.orders[first]["token"]
+            ask = account.orders.orders[first]["price"]
+            account.client.get_orders = get_orders_then_place
+            await account.orders.poll()
+            account.client.get_orders = get_orders
+
+            assert len(account.orders) == 2
+            placed = next(order for order_id, order in account.orders.orders.items() if order_id != first)
+            assert placed["matched"] == 0 and not placed["cancelled"]
+            assert mock.requests.get(("GET", "/data/order/"), 0) == 0  # 没有被当成已结束去查最终状态
+            await account.orders.poll()
+            assert placed["matched"] == pytest.approx(50 * FILL_RATIO)
+    asyncio.run(scenario())
@@ -0,0 +1,93 @@
+"""实时流：对着 MockPolymarket 的 WebSocket 检测序号跳变，丢掉的成交由 REST 补齐"""
+import asyncio
+import os
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def stream_env(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    for key, value in dict(STATE_DB="", METRICS_PORT="0", RECORD_DIR="", ACCOUNTS="", PAPER_MODE="true",
+                           INGEST_MODE="stream", POLL_INTERVAL="1", COALESCE_WINDOW="0",
+                           DATA_API_RPS="1000").items():
+        monkeypatch.setenv(key, value)
+
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+async def make_trades_until_gap(mock, gaps: int = 2):
+    """逐笔生成成交，直到出现 gaps 次丢消息且最后一笔已推送（跳变能被下一条消息发现）"""
+    stats = mock.stream_stats
+    while True:
+        sent, handled = stats["messages"], stats["messages"] + stats["gaps"]
+        mock.make_trade()
+        await wait_for(lambda: stats["messages"] + stats["gaps"] > handled)  # 推送或丢弃
+        if stats["gaps"] >= gaps and stats["messages"] > sent:
+            return
+
+
+def test_sequence_gap_marks_resync():
+    async def scenario():
+        mock = bot.MockPolymarket(wallets=2, positions=5, trade_rate=0, stream_gap_rate=0.5, seed=1)
+        server, port = await mock.serve(0)
+        stream = bot.TradeStream(mock.wallets, url=f"ws://127.0.0.1:{port}")
+        received = []
+
+        async def process_trade(wallet, trade):
+            received.append(trade["id"])
+
+        task = asyncio.create_task(stream.run(process_trade))
+        try:
+            await wait_for(lambda: stream.connected and mock._subscribers)
+            stream.resync_needed = False
+            await make_trades_until_gap(mock)
+            await wait_for(lambda: len(received) == mock.stream_stats["messages"])
+            assert stream.gaps >= 1
+            assert stream.resync_needed
+            assert stream.reconnects == 0
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            server.close()
+    asyncio.run(scenario())
+
+
+def test_dropped_trades_are_recovered_over_rest():
+    async def scenario():
+        mock = bot.MockPolymarket(wallets=2, positions=5, trade_rate=0, stream_gap_rate=0.5, seed=2)
+        server, port = await mock.serve(0)
+        url = f"http://127.0.0.1:{port}"
+        os.environ.update(DATA_API_URL=url, CLOB_HOST=url, STREAM_URL=f"ws://127.0.0.1:{port}")
+        trader = bot.RESTCopyTrader(None, mock.wallets)
+        sources = {}
+        process_trade = trader.process_trade
+
+        async def record(wallet, trade):
+            sources.setdefault(trade["id"], trade["source"])
+            await process_trade(wallet, trade)
+
+        trader.process_trade = record
+        task = asyncio.create_task(trader.run_stream())
+        try:
+            await wait_for(lambda: getattr(trader, "stream", None) and trader.stream.connected and mock._subscribers
+                           and len(trader.tracker.baselined) == len(mock.wallets))
+            await make_trades_until_gap(mock)
+            generated = [bot.trade_record_id(trade) for trades in mock.trades.values() for trade in trades]
+            await wait_for(lambda: all(trade_id in sources for trade_id in generated))
+            assert trader.stream.gaps >= 1
+            assert "trades" in {sources[trade_id] for trade_id in generated}  # 丢掉的那几笔来自 REST
+            assert "stream" in {sources[trade_id] for trade_id in generated}
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await trader.http.aclose()
+            server.close()
+    asyncio.run(scenario())